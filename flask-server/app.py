@@ -1,13 +1,35 @@
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import (
+    Flask,
+    Response,
+    request,
+    jsonify,
+    send_file,
+    send_from_directory,
+    abort,
+    g,
+    stream_with_context,
+)
 from flask_cors import CORS
+import json
 import os
-import requests
-from PIL import Image
-from werkzeug.utils import secure_filename
-from model import get_caption_model, generate_caption
-from translate import Translator
-import subprocess
-import sys
+import time
+from werkzeug.utils import safe_join, secure_filename
+from batch_captioning import BatchCaptioner, ThroughputReport
+from caption_cache import CaptionCache, perceptual_hash
+from embedding_cache import content_hash
+from feature_store import list_images
+from feedback_store import FeedbackStore
+from image_fetcher import FetchError, FetchTimeout, FetchTooLarge, ImageFetcher
+from image_ingest import ImageInput
+from model import embedding_cache, DECODING_STRATEGIES
+from model_registry import ModelRegistry, ModelNotReadyError
+from inference_scheduler import InferenceScheduler
+from metrics import metrics
+from retrain_model import retrain_model
+from retrain_queue import RetrainQueue
+from serving_model import load_caption_model, model_version
+from translation_service import TranslationService
+from upload_store import UploadStore, content_digest
 
 app = Flask(__name__)
 
@@ -23,11 +45,29 @@ cors = CORS(
     },
 )
 
-UPLOAD_FOLDER = "uploads"
+# Uploads and the databases; the benchmarks point this at a temp directory.
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+UPLOAD_FOLDER = os.path.join(DATA_DIR, "uploads")
+UPLOAD_MAX_BYTES = 10 * 1024**3  # least recently used uploads are evicted beyond
+UPLOAD_MAX_AGE = 365 * 24 * 3600  # seconds browsers may cache an uploaded image
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
-RETRAIN_MODEL_SCRIPT = os.path.join(os.path.dirname(__file__), "retrain_model.py")
-USER_FEEDBACK_FILE = os.path.join(os.path.dirname(__file__), "user_feedback.csv")
+USER_FEEDBACK_DB = os.path.join(DATA_DIR, "user_feedback.db")
+TRANSLATION_CACHE_FILE = os.path.join(DATA_DIR, "translation_cache.jsonl")
+CAPTION_CACHE_DB = os.path.join(DATA_DIR, "caption_cache.db")
+CAPTION_CACHE_TTL_SECONDS = 7 * 24 * 3600
+CAPTION_CACHE_BYTES = 64 * 1024 * 1024
+MAX_CAPTIONS = 10
+MODEL_LOAD_TIMEOUT = 120  # seconds a request waits for the model while it warms up
+INFERENCE_MAX_BATCH_SIZE = 8  # captioning jobs run together in one batch
+INFERENCE_MAX_WAIT_MS = 10  # how long the first job of a batch waits for others
+MAX_FETCH_URLS = 16  # URLs accepted by one /fetch request
+MAX_BATCH_IMAGES = 10000  # images accepted by one /batch request
+# Server-side images /batch may caption by directory or manifest; unset
+# disables both.
+BATCH_INPUT_DIR = os.environ.get("BATCH_INPUT_DIR")
+RETRAIN_COALESCE_SECONDS = 30  # confirmations within this window share one run
+MODEL_POLL_SECONDS = 60  # how often a worker checks for a newer fine-tuning
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -36,32 +76,236 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
 default_language = "pl"
-translator = Translator(to_lang=default_language)
+translation_service = TranslationService(path=TRANSLATION_CACHE_FILE)
+
+upload_store = UploadStore(UPLOAD_FOLDER, max_bytes=UPLOAD_MAX_BYTES)
+image_fetcher = ImageFetcher(MAX_CONTENT_LENGTH)
+model_registry = ModelRegistry(loader=load_caption_model, version=model_version)
+model_registry.start()
+# With several server workers, fine-tuning happens in whichever one received
+# the confirmation; the others reload once its checkpoint appears.
+model_registry.watch(MODEL_POLL_SECONDS)
+inference_scheduler = InferenceScheduler(
+    model_registry,
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_wait_ms=INFERENCE_MAX_WAIT_MS,
+    model_timeout=MODEL_LOAD_TIMEOUT,
+)
+feedback_store = FeedbackStore(USER_FEEDBACK_DB)
+caption_cache = CaptionCache(
+    CAPTION_CACHE_DB, ttl=CAPTION_CACHE_TTL_SECONDS, max_bytes=CAPTION_CACHE_BYTES
+)
+
+
+def retrain_and_reload(progress):
+    trained = retrain_model(progress=progress)
+    # A TFLite model does not change with fine-tuning; see model_version.
+    if trained and model_version() != model_registry.version:
+        model_registry.reload()
+    return trained
+
+
+retrain_queue = RetrainQueue(
+    retrain_and_reload, coalesce_seconds=RETRAIN_COALESCE_SECONDS
+)
+
+REQUESTS = metrics.counter(
+    "http_requests_total",
+    "Requests by route, method and status",
+    ["route", "method", "status"],
+)
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_seconds", "Time until the response headers, by route", ["route"]
+)
+
+
+def service_metrics():
+    # Read from the services' own counters at scrape time.
+    embeddings = embedding_cache.stats()
+    translations = translation_service.stats()
+    captions = caption_cache.stats()
+    scheduler = inference_scheduler.stats()
+    counters = [
+        ("embedding_cache_hits_total", {"tier": "memory"}, embeddings["hits"]),
+        ("embedding_cache_hits_total", {"tier": "disk"}, embeddings["disk_hits"]),
+        ("embedding_cache_misses_total", {}, embeddings["misses"]),
+        ("translation_cache_hits_total", {}, translations["hits"]),
+        ("translation_cache_misses_total", {}, translations["misses"]),
+        ("caption_cache_hits_total", {"match": "exact"}, captions["hits"]),
+        ("caption_cache_hits_total", {"match": "near"}, captions["near_hits"]),
+        ("caption_cache_misses_total", {}, captions["misses"]),
+        ("inference_batches_total", {}, scheduler["batches"]),
+        ("inference_jobs_total", {}, scheduler["jobs"]),
+        ("inference_failed_jobs_total", {}, scheduler["failed_jobs"]),
+    ]
+    gauges = [
+        ("caption_model_ready", {}, int(model_registry.ready)),
+        ("embedding_cache_bytes", {}, embeddings["bytes"]),
+        ("inference_queue_depth", {}, scheduler["queue_depth"]),
+    ]
+    return [(name, "counter", labels, value) for name, labels, value in counters] + [
+        (name, "gauge", labels, value) for name, labels, value in gauges
+    ]
+
+
+def shared_metrics():
+    # The caption cache database is shared by all workers; counted once.
+    return [("caption_cache_bytes", "gauge", {}, caption_cache.stats()["bytes"])]
+
+
+metrics.add_collector(service_metrics)
+metrics.add_collector(shared_metrics, shared=True)
+metrics.start()
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses (/batch) are timed up to their first byte.
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route=route)
+    return response
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def generate_unique_captions(image_path, previous_captions, model):
+def decoding_options(data):
+    strategy = data.get("strategy", "noise")
+    if strategy not in DECODING_STRATEGIES:
+        raise ValueError(f"Unknown decoding strategy: {strategy}")
+
+    options = {"strategy": strategy}
+    for key, cast in (
+        ("num_captions", int),
+        ("beam_width", int),
+        ("top_k", int),
+        ("top_p", float),
+        ("temperature", float),
+        ("seed", int),
+    ):
+        if data.get(key) is not None:
+            try:
+                options[key] = cast(data[key])
+            except (TypeError, ValueError, OverflowError):
+                # a list or object, or int() of an overflowing float
+                raise ValueError(f"'{key}' must be a number") from None
+
+    if not 1 <= options.get("num_captions", 5) <= MAX_CAPTIONS:
+        raise ValueError(f"'num_captions' must be between 1 and {MAX_CAPTIONS}")
+    if not 1 <= options.get("beam_width", 1) <= MAX_CAPTIONS:
+        raise ValueError(f"'beam_width' must be between 1 and {MAX_CAPTIONS}")
+    if not options.get("temperature", 1.0) > 0:  # also rejects NaN
+        raise ValueError("'temperature' must be greater than 0")
+    if not 0 < options.get("top_p", 1.0) <= 1:
+        raise ValueError("'top_p' must be greater than 0 and at most 1")
+    if options.get("top_k", 1) < 1:
+        raise ValueError("'top_k' must be at least 1")
+    if options.get("seed", 0) < 0:
+        raise ValueError("'seed' must not be negative")
+    return options
+
+
+def generate_unique_captions(image, previous_captions, refresh=False, **options):
     captions = set(previous_captions)
-    captions.add(generate_caption(image_path, model))
-    captions.update(
-        generate_caption(image_path, model, add_noise=True) for _ in range(4)
-    )
+    captions.update(cached_captions(image, refresh, **options))
     return list(captions)
 
 
-def save_image(file):
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    file.save(file_path)
-    return filename
+def cached_captions(image, refresh=False, **options):
+    # Captions of the same or a near-duplicate image with the same options
+    # come from the caption cache; refresh computes new ones and replaces
+    # the cached captions.
+    return pending_captions(image, refresh, **options)()
+
+
+def pending_captions(image, refresh=False, **options):
+    # Like cached_captions, but a cache miss is only submitted to the
+    # scheduler; the returned function waits for the captions. Images of one
+    # request submitted together share inference batches.
+    if not model_registry.ready:
+        return inference_scheduler.submit(image, **options).result
+    version = model_registry.version  # before captioning, in case of a reload
+    if isinstance(image, ImageInput):
+        data = image.data
+    else:
+        with open(image, "rb") as f:
+            data = f.read()
+    image_hash = content_hash(data)
+    try:
+        phash = perceptual_hash(data)
+    except Exception:
+        phash = None
+
+    if not refresh:
+        captions = caption_cache.get(image_hash, phash, options, version)
+        if captions is not None:
+            return lambda: captions
+    future = inference_scheduler.submit(image, **options)
+
+    def result():
+        captions = future.result()
+        caption_cache.put(image_hash, phash, options, version, captions)
+        return captions
+
+    return result
+
+
+def save_image(data):
+    # The original bytes are written in the background under their content
+    # hash; captioning works on the in-memory copy.
+    return upload_store.save(data)
+
+
+def stored_image_hash(filename):
+    digest = content_digest(filename)
+    if digest is not None:
+        return digest  # content-addressed uploads are named by their hash
+    path = upload_store.path(filename)
+    if path is None:
+        return None
+    upload_store.wait(path)
+    try:
+        with open(path, "rb") as f:
+            return content_hash(f.read())
+    except OSError:
+        return None
+
+
+def read_image(data):
+    image = ImageInput(data)
+    image.tensor()  # decode in the request thread; raises on invalid images
+    return image
 
 
 @app.route("/api", methods=["GET"])
 def health_check():
-    return jsonify({"status": "success", "message": "Server is running!"}), 200
+    return jsonify(
+        {
+            "status": "success",
+            "message": "Server is running!",
+            "model": model_registry.status(),
+            "embedding_cache": embedding_cache.stats(),
+            "scheduler": inference_scheduler.stats(),
+            "translation_cache": translation_service.stats(),
+            "caption_cache": caption_cache.stats(),
+            "retraining": retrain_queue.stats(),
+            "feedback": feedback_store.stats(),
+            "uploads": upload_store.stats(),
+        }
+    ), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/upload", methods=["POST"])
@@ -74,35 +318,188 @@ def upload_image():
         return jsonify({"status": "error", "message": "No selected file"}), 400
     if not allowed_file(file.filename):
         return jsonify({"status": "error", "message": "File type not allowed"}), 400
+    try:
+        options = decoding_options(request.form)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    data = file.read()
+    try:
+        image = read_image(data)
+    except Exception:
+        return jsonify({"status": "error", "message": "Invalid image file"}), 400
 
-    filename = save_image(file)
-    image_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    model = get_caption_model()
-    captions = generate_unique_captions(image_path, [], model)
+    filename = save_image(data)
+    captions = generate_unique_captions(image, [], **options)
     return jsonify({"status": "success", "captions": captions, "image_path": filename})
 
 
+def fetch_error_response(error):
+    if isinstance(error, FetchTooLarge):
+        return {"status": "error", "message": "File too large"}, 413
+    if isinstance(error, FetchTimeout):
+        return {"status": "error", "message": str(error)}, 504
+    return {"status": "error", "message": str(error)}, 500
+
+
+def start_fetched_captioning(url, data, options):
+    # Returns the pending captions and stored filename, or an error response.
+    if isinstance(data, FetchError):
+        return fetch_error_response(data)
+    try:
+        image = read_image(data)
+    except Exception:
+        return {"status": "error", "message": "Invalid image file"}, 400
+    filename = save_image(data)
+    return pending_captions(image, **options), filename
+
+
 @app.route("/fetch", methods=["POST"])
 def fetch_image():
+    try:
+        options = decoding_options(request.json)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    urls = request.json.get("urls")
+    if urls is not None:
+        return fetch_images(urls, options)
+
     url = request.json.get("url")
     if not url:
         return jsonify({"status": "error", "message": "No URL provided"}), 400
 
+    if not allowed_file(secure_filename(os.path.basename(url))):
+        return jsonify({"status": "error", "message": "File type not allowed"}), 400
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        img = Image.open(response.raw).convert("RGB")
-        filename = secure_filename(os.path.basename(url))
-        if not allowed_file(filename):
-            return jsonify({"status": "error", "message": "File type not allowed"}), 400
-        image_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        img.save(image_path)
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        data = image_fetcher.fetch(url)
+    except FetchError as e:
+        body, status = fetch_error_response(e)
+        return jsonify(body), status
+
+    outcome, detail = start_fetched_captioning(url, data, options)
+    if isinstance(outcome, dict):
+        return jsonify(outcome), detail
+    captions = list(set(outcome()))
+    return jsonify({"status": "success", "captions": captions, "image_path": detail})
+
+
+def fetch_images(urls, options):
+    if not isinstance(urls, list) or not urls:
+        return jsonify({"status": "error", "message": "No URLs provided"}), 400
+    if len(urls) > MAX_FETCH_URLS:
+        return jsonify(
+            {"status": "error", "message": f"At most {MAX_FETCH_URLS} URLs allowed"}
+        ), 400
 
-    model = get_caption_model()
-    captions = generate_unique_captions(image_path, [], model)
-    return jsonify({"status": "success", "captions": captions, "image_path": filename})
+    # Downloads run concurrently and every image the caption cache does not
+    # answer joins the same inference batches; results keep request order.
+    allowed = list(
+        dict.fromkeys(
+            url for url in urls if allowed_file(secure_filename(os.path.basename(url)))
+        )
+    )
+    fetched = dict(zip(allowed, image_fetcher.fetch_many(allowed)))
+    pending = [
+        start_fetched_captioning(url, fetched[url], options)
+        if url in fetched
+        else ({"status": "error", "message": "File type not allowed"}, 400)
+        for url in urls
+    ]
+    results = []
+    for url, (outcome, detail) in zip(urls, pending):
+        if isinstance(outcome, dict):
+            results.append(dict(outcome, url=url, code=detail))
+            continue
+        try:
+            captions = list(set(outcome()))
+        except ModelNotReadyError:
+            raise
+        except Exception as e:
+            results.append({"status": "error", "message": str(e), "url": url})
+            continue
+        results.append(
+            {
+                "status": "success",
+                "url": url,
+                "captions": captions,
+                "image_path": detail,
+            }
+        )
+    return jsonify({"status": "success", "results": results})
+
+
+@app.route("/batch", methods=["POST"])
+def batch_captions():
+    # Streams one JSON line per image, then a line with the throughput report.
+    data = request.json
+    root = None
+    if data.get("urls"):
+        sources = data["urls"]
+    elif data.get("directory") or data.get("manifest"):
+        if BATCH_INPUT_DIR is None:
+            return jsonify(
+                {"status": "error", "message": "Directory input is disabled"}
+            ), 400
+        root = os.path.abspath(BATCH_INPUT_DIR)
+        if data.get("directory"):
+            directory = safe_join(root, data["directory"])
+            if directory is None or not os.path.isdir(directory):
+                return jsonify({"status": "error", "message": "Unknown directory"}), 400
+            sources = list_images(directory)
+        else:
+            manifest = safe_join(root, data["manifest"])
+            if manifest is None or not os.path.isfile(manifest):
+                return jsonify({"status": "error", "message": "Unknown manifest"}), 400
+            try:
+                sources = list_images(manifest)
+            except (KeyError, TypeError, ValueError):
+                return jsonify({"status": "error", "message": "Invalid manifest"}), 400
+            # Manifest paths may point anywhere; only URLs and images under
+            # the batch input directory are accepted.
+            if any(
+                "://" not in source
+                and os.path.commonpath([root, os.path.abspath(source)]) != root
+                for source in sources
+            ):
+                return jsonify(
+                    {"status": "error", "message": "Image outside the input directory"}
+                ), 400
+    else:
+        return jsonify(
+            {
+                "status": "error",
+                "message": "Missing required data: 'urls', 'directory' or 'manifest'",
+            }
+        ), 400
+    if not isinstance(sources, list) or len(sources) > MAX_BATCH_IMAGES:
+        return jsonify(
+            {"status": "error", "message": f"At most {MAX_BATCH_IMAGES} images allowed"}
+        ), 400
+    try:
+        options = decoding_options(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    # Fail with 503 before streaming if the model does not come up.
+    model_registry.get(timeout=MODEL_LOAD_TIMEOUT)
+    # Images join the same inference batches as the other requests.
+    captioner = BatchCaptioner(
+        options=options, fetcher=image_fetcher, scheduler=inference_scheduler
+    )
+
+    def generate():
+        report = ThroughputReport()
+        for result in captioner.caption(sources):
+            report.add(result)
+            if root is not None and "://" not in result["image"]:
+                # Names relative to the input directory, not server paths
+                result["image"] = os.path.relpath(result["image"], root)
+                if "error" in result:
+                    result["error"] = result["error"].replace(root + os.sep, "")
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"report": report.as_dict()}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 @app.route("/regenerate", methods=["POST"])
@@ -112,11 +509,18 @@ def regenerate_captions():
         return jsonify(
             {"status": "error", "message": "Missing required data: 'image_path'"}
         ), 400
-
-    model = get_caption_model()
-    captions = generate_unique_captions(
-        os.path.join(app.config["UPLOAD_FOLDER"], image_path), [], model
-    )
+    try:
+        options = decoding_options(request.json)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    image_path = upload_store.path(image_path)
+    if image_path is None:
+        return jsonify({"status": "error", "message": "Unknown image"}), 404
+    upload_store.wait(image_path)
+    if not os.path.exists(image_path):
+        return jsonify({"status": "error", "message": "Unknown image"}), 404
+    captions = generate_unique_captions(image_path, [], refresh=True, **options)
     return jsonify({"status": "success", "captions": captions})
 
 
@@ -135,27 +539,30 @@ def confirm_choice():
         ), 400
 
     try:
-        with open(USER_FEEDBACK_FILE, "a") as f:
-            f.write(f"{image_path},{selected_caption}\n")
-
-        result = subprocess.run(
-            [sys.executable, RETRAIN_MODEL_SCRIPT],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-        return jsonify(
-            {
-                "status": "success",
-                "message": "Model został zaktualizowany w oparciu o Twoją opinie!",
-                "output": result.stdout,
-            }
-        )
-    except subprocess.CalledProcessError as e:
+        feedback_store.add(image_path, selected_caption, stored_image_hash(image_path))
+    except Exception as e:
+        # The database is locked, unwritable, or the commit timed out.
         return jsonify(
-            {"status": "error", "message": f"Error during model update: {e.stderr}"}
+            {"status": "error", "message": f"Could not save feedback: {e}"}
         ), 500
 
+    job_id = retrain_queue.submit()
+    return jsonify(
+        {
+            "status": "success",
+            "message": "Dziękujemy za opinię! Model zostanie zaktualizowany w tle.",
+            "job_id": job_id,
+        }
+    ), 202
+
+
+@app.route("/retrain/<job_id>", methods=["GET"])
+def retrain_status(job_id):
+    status = retrain_queue.status(job_id)
+    if status is None:
+        return jsonify({"status": "error", "message": "Unknown job ID"}), 404
+    return jsonify({"status": "success", "job": status})
+
 
 @app.route("/translate", methods=["POST"])
 def translate_captions():
@@ -172,9 +579,7 @@ def translate_captions():
         ), 400
 
     try:
-        translated_captions = [
-            Translator(to_lang=language).translate(caption) for caption in captions
-        ]
+        translated_captions = translation_service.translate_many(captions, language)
         return jsonify(
             {"status": "success", "translated_captions": translated_captions}
         )
@@ -184,7 +589,30 @@ def translate_captions():
 
 @app.route("/uploads/<filename>")
 def serve_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    digest = content_digest(filename)
+    if digest is None:
+        # Uploads saved before content addressing may have been overwritten.
+        return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+
+    path = upload_store.path(filename)
+    upload_store.wait(path)
+    if not os.path.isfile(path):
+        abort(404)
+    upload_store.touch(path)
+    # The name is the content hash, so the hash is a strong ETag and the
+    # response never changes. send_file answers If-None-Match with 304 and
+    # Range requests with 206.
+    response = send_file(
+        os.path.abspath(path), etag=digest, conditional=True, max_age=UPLOAD_MAX_AGE
+    )
+    response.cache_control.immutable = True
+    response.accept_ranges = "bytes"
+    return response
+
+
+@app.errorhandler(ModelNotReadyError)
+def model_not_ready(error):
+    return jsonify({"status": "error", "message": str(error)}), 503
 
 
 @app.errorhandler(413)
@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from feature_store import list_images
+from image_fetcher import ImageFetcher
+from image_ingest import ImageInput
+from model import caption_images
+
+BATCH_SIZE = 32
+DECODE_WORKERS = 8
+MAX_IMAGE_BYTES = 16 * 1024 * 1024
+BULK_OPTIONS = {"strategy": "noise", "num_captions": 1}  # one greedy caption
+
+
+class BatchCaptioner:
+    """Captions a stream of image paths and URLs in batches.
+
+    A thread pool reads, fetches and decodes the next images while the
+    current batch goes through one cnn_model pass and batched decoding.
+    Results are yielded per image as each batch completes; images that fail
+    to load are reported right away. With a scheduler (an
+    InferenceScheduler), batches are submitted to it instead of running on
+    the calling thread.
+    """
+
+    def __init__(
+        self,
+        caption_model=None,
+        batch_size=BATCH_SIZE,
+        decode_workers=DECODE_WORKERS,
+        options=None,
+        fetcher=None,
+        scheduler=None,
+    ):
+        self.caption_model = caption_model
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.options = dict(BULK_OPTIONS, **(options or {}))
+        self.fetcher = fetcher or ImageFetcher(MAX_IMAGE_BYTES)
+
+    def load(self, source):
+        if "://" in source:
+            data = self.fetcher.fetch(source)
+        else:
+            with open(source, "rb") as f:
+                data = f.read()
+        image = ImageInput(data)
+        image.tensor()  # decode in the worker thread
+        return image
+
+    def caption(self, sources):
+        sources = iter(sources)
+        # Keep two batches of loads in flight ahead of inference.
+        prefetch = 2 * self.batch_size
+        with ThreadPoolExecutor(
+            max_workers=self.decode_workers, thread_name_prefix="batch-decode"
+        ) as pool:
+            window = deque(
+                (source, pool.submit(self.load, source))
+                for source in islice(sources, prefetch)
+            )
+            batch = []
+            while window:
+                source, future = window.popleft()
+                next_source = next(sources, None)
+                if next_source is not None:
+                    window.append((next_source, pool.submit(self.load, next_source)))
+                try:
+                    batch.append((source, future.result()))
+                except Exception as e:
+                    yield {"image": source, "error": str(e)}
+                    continue
+                if len(batch) == self.batch_size:
+                    yield from self._caption_batch(batch)
+                    batch = []
+            if batch:
+                yield from self._caption_batch(batch)
+
+    def _caption_batch(self, batch):
+        if self.scheduler is not None:
+            # The scheduler retries a failed batch image by image itself.
+            futures = [
+                self.scheduler.submit(image, **self.options) for _, image in batch
+            ]
+            for (source, _), future in zip(batch, futures):
+                try:
+                    yield {"image": source, "captions": future.result()}
+                except Exception as e:
+                    yield {"image": source, "error": str(e)}
+            return
+        try:
+            results = caption_images(
+                [image for _, image in batch],
+                self.caption_model,
+                [self.options] * len(batch),
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                yield {"image": batch[0][0], "error": str(e)}
+                return
+            logging.warning("Batch failed, captioning images singly: %s", e)
+            for item in batch:
+                yield from self._caption_batch([item])
+            return
+
+        for (source, _), captions in zip(batch, results):
+            yield {"image": source, "captions": captions}
+
+
+class ThroughputReport:
+    def __init__(self, skipped=0):
+        self.started = time.perf_counter()
+        self.images = 0
+        self.errors = 0
+        self.skipped = skipped
+
+    def add(self, result):
+        self.images += 1
+        self.errors += "error" in result
+
+    def as_dict(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "images": self.images,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "seconds": seconds,
+            "images_per_second": self.images / seconds if seconds else 0.0,
+        }
+
+
+def completed_images(output_path):
+    # Images already in a previous run's output. A line cut short by a crash
+    # is removed, so appending continues on a clean line boundary.
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            valid_bytes += len(line)
+            # Failed images are retried on resume.
+            if "captions" in result:
+                done.add(result["image"])
+    with open(output_path, "r+b") as f:
+        f.truncate(valid_bytes)
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Caption a directory, a manifest or a list of URLs to JSONL"
+    )
+    parser.add_argument("source", help="directory, manifest file or image URL")
+    parser.add_argument("--output", help="JSONL file, resumed if it exists")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--strategy", default=BULK_OPTIONS["strategy"])
+    parser.add_argument(
+        "--num-captions", type=int, default=BULK_OPTIONS["num_captions"]
+    )
+    parser.add_argument("--progress-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    sources = [args.source] if "://" in args.source else list_images(args.source)
+    done = completed_images(args.output) if args.output else set()
+    sources = [source for source in sources if source not in done]
+
+    from serving_model import load_caption_model
+
+    captioner = BatchCaptioner(
+        load_caption_model(),
+        batch_size=args.batch_size,
+        decode_workers=args.decode_workers,
+        options={"strategy": args.strategy, "num_captions": args.num_captions},
+    )
+    report = ThroughputReport(skipped=len(done))
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for result in captioner.caption(sources):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            report.add(result)
+            if report.images % args.progress_every == 0:
+                print(json.dumps(report.as_dict()), file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(report.as_dict(), indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Offline benchmarks of the captioning hot paths.
+
+Runs on a CPU-only machine without network access or weight files: the
+real architecture from model.py is built with seeded random weights, and
+the images are generated deterministically. Threads are pinned (--threads)
+so that results are comparable between runs on the same machine.
+
+    python benchmarks.py run --output results.json
+    python benchmarks.py run --baseline
+    python benchmarks.py run --save-baseline
+
+With --baseline, every benchmark whose median is more than --tolerance
+slower than in the baseline is reported as a regression and the command
+exits with status 1. The baseline defaults to the committed
+benchmark_baseline.json; a missing baseline file is an error. Baselines
+are only meaningful on the machine and thread count they were recorded
+with; a mismatch is reported as well, and --save-baseline records a new
+one for this machine.
+"""
+
+import argparse
+import atexit
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from serving_benchmark import sample_image
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(ROOT_DIR, "benchmark_baseline.json")
+SEED = 0
+REPEATS = 10
+WARMUP = 2
+BATCH_SIZES = (1, 4, 16)
+TOLERANCE = 0.25  # a median this much slower than the baseline fails
+GROUPS = ("startup", "preprocess", "cnn", "caption", "decode", "routes")
+
+
+def summarize(seconds, unit_scale=1000, per=1):
+    values = np.asarray(seconds) * unit_scale / per
+    return {
+        "median": float(np.median(values)),
+        "p90": float(np.percentile(values, 90)),
+        "min": float(values.min()),
+        "runs": len(values),
+        "unit": "ms",
+    }
+
+
+def measure(fn, repeats=REPEATS, warmup=WARMUP, per=1, setup=None):
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - started)
+    return summarize(seconds, per=per)
+
+
+def time_startup():
+    # Run in a fresh interpreter by bench_startup; TensorFlow import excluded.
+    import tensorflow as tf
+
+    from model import build_caption_model
+
+    tf.keras.utils.set_random_seed(SEED)
+    started = time.perf_counter()
+    build_caption_model()
+    return time.perf_counter() - started
+
+
+def bench_startup(repeats):
+    seconds = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, __file__, "time-startup"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        seconds.append(float(output.strip().splitlines()[-1]))
+    return {"startup.build_caption_model": summarize(seconds)}
+
+
+def bench_preprocess(repeats):
+    from image_ingest import decode_image_bytes
+    from model import load_image_from_path
+
+    data = sample_image(seed=SEED)
+    results = {
+        "preprocess.decode_image_bytes": measure(
+            lambda: decode_image_bytes(data), repeats
+        )
+    }
+    with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+        f.write(data)
+        f.flush()
+        results["preprocess.load_image_from_path"] = measure(
+            lambda: load_image_from_path(f.name), repeats
+        )
+    return results
+
+
+def bench_cnn(caption_model, repeats, batch_sizes):
+    import tensorflow as tf
+
+    results = {}
+    for batch_size in batch_sizes:
+        images = tf.random.stateless_uniform(
+            (batch_size, 299, 299, 3), seed=(SEED, batch_size), minval=-1, maxval=1
+        )
+        results[f"cnn.batch_{batch_size}.per_image"] = measure(
+            lambda: caption_model.cnn_model(images, training=False).numpy(),
+            repeats,
+            per=batch_size,
+        )
+    return results
+
+
+def bench_caption(caption_model, repeats):
+    from model import embedding_cache, generate_caption
+    from image_ingest import ImageInput
+
+    image = ImageInput(sample_image(seed=SEED))
+    caption = generate_caption(image, caption_model)
+    return {
+        # Cleared cache: decode, CNN, encoder and the decode loop.
+        "generate_caption.cold": measure(
+            lambda: generate_caption(image, caption_model),
+            repeats,
+            setup=embedding_cache.clear,
+        ),
+        # Cached embedding: the encoder and the decode loop only.
+        "generate_caption.cached_embedding": measure(
+            lambda: generate_caption(image, caption_model), repeats
+        ),
+    }, {"caption_tokens": len(caption.split())}
+
+
+def bench_decode(caption_model, repeats, batch_sizes):
+    import tensorflow as tf
+
+    from model import MAX_LENGTH, START_TOKEN_ID
+
+    decoder = caption_model.decoder
+    steps = MAX_LENGTH - 1
+    results = {}
+    for batch_size in batch_sizes:
+        img_embed = caption_model.cnn_model(
+            tf.random.stateless_uniform(
+                (batch_size, 299, 299, 3), seed=(SEED, 1), minval=-1, maxval=1
+            )
+        )
+        img_encoded = caption_model.encoder(img_embed, training=False)
+
+        def decode():
+            # Every step runs, whatever the random weights predict.
+            cache = decoder.init_cache(img_encoded)
+            token_ids = tf.fill([batch_size], tf.constant(START_TOKEN_ID, tf.int64))
+            for i in range(steps):
+                logits, cache = decoder.decode_step(token_ids, i, cache)
+                token_ids = tf.argmax(logits, axis=-1)
+            token_ids.numpy()
+
+        results[f"decode_step.batch_{batch_size}.per_token"] = measure(
+            decode, repeats, per=steps
+        )
+    return results
+
+
+def bench_routes(caption_model, repeats):
+    # The app is imported with its model loader pointed at the random model,
+    # and its uploads and databases in a temporary directory.
+    import serving_model
+
+    serving_model.load_caption_model = lambda: caption_model
+    data_dir = tempfile.mkdtemp(prefix="caption-benchmark-")
+    atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+    os.environ["DATA_DIR"] = data_dir
+    import app
+
+    app.model_registry.get(timeout=600)
+    client = app.app.test_client()
+    counter = iter(range(10**9))
+
+    def upload():
+        # A new image every time, so neither the embedding cache nor the
+        # caption cache (which also matches near-duplicates) answers.
+        data = sample_image(seed=SEED + next(counter))
+        response = client.post(
+            "/upload",
+            data={"file": (io.BytesIO(data), "benchmark.jpg")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.json["image_path"]
+
+    image_path = upload()
+    app.upload_store.wait(app.upload_store.path(image_path))
+
+    def regenerate():
+        response = client.post("/regenerate", json={"image_path": image_path})
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    def health():
+        assert client.get("/api").status_code == 200
+
+    return {
+        "route.upload": measure(upload, repeats),
+        "route.regenerate": measure(regenerate, repeats),
+        "route.api": measure(health, repeats),
+    }
+
+
+def environment(threads):
+    import tensorflow as tf
+
+    return {
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "threads": threads,
+    }
+
+
+def run(groups, repeats, threads, batch_sizes):
+    import tensorflow as tf
+
+    from model import build_caption_model
+
+    results = {}
+    extra = {}
+    if "startup" in groups:
+        results.update(bench_startup(max(3, repeats // 3)))
+    if "preprocess" in groups:
+        results.update(bench_preprocess(repeats))
+
+    tf.keras.utils.set_random_seed(SEED)
+    caption_model = build_caption_model()
+    if "cnn" in groups:
+        results.update(bench_cnn(caption_model, repeats, batch_sizes))
+    if "caption" in groups:
+        caption_results, extra = bench_caption(caption_model, repeats)
+        results.update(caption_results)
+    if "decode" in groups:
+        results.update(bench_decode(caption_model, repeats, batch_sizes))
+    if "routes" in groups:
+        results.update(bench_routes(caption_model, repeats))
+
+    return {
+        "environment": environment(threads),
+        "config": dict(
+            seed=SEED,
+            repeats=repeats,
+            warmup=WARMUP,
+            batch_sizes=list(batch_sizes),
+            **extra,
+        ),
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    # Returns the names of the benchmarks that regressed.
+    regressions = []
+    for key in ("tensorflow", "cpu_count", "threads"):
+        if report["environment"][key] != baseline["environment"][key]:
+            print(
+                f"WARNING: {key} is {report['environment'][key]}, the baseline "
+                f"was recorded with {baseline['environment'][key]}",
+                file=sys.stderr,
+            )
+
+    skipped = 0
+    for name, expected in sorted(baseline["results"].items()):
+        result = report["results"].get(name)
+        if result is None:
+            skipped += 1
+            continue
+        ratio = result["median"] / expected["median"]
+        if ratio > 1 + tolerance:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            verdict = "faster"
+        else:
+            verdict = "ok"
+        print(
+            f"{name:45} {expected['median']:10.2f} -> {result['median']:10.2f} ms"
+            f"  {ratio:5.2f}x  {verdict}",
+            file=sys.stderr,
+        )
+    if skipped:
+        print(f"{skipped} baseline benchmark(s) not run", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--only", nargs="+", choices=GROUPS, default=GROUPS)
+    run_parser.add_argument("--repeats", type=int, default=REPEATS)
+    run_parser.add_argument("--threads", type=int, default=1)
+    run_parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    run_parser.add_argument("--output", help="write the results here")
+    run_parser.add_argument(
+        "--baseline",
+        nargs="?",
+        const=BASELINE_PATH,
+        help="fail on regressions against this (benchmark_baseline.json)",
+    )
+    run_parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=BASELINE_PATH,
+        help="store the results as baseline (benchmark_baseline.json)",
+    )
+    run_parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    subparsers.add_parser("time-startup")
+    args = parser.parse_args()
+
+    # model.py pins the TensorFlow thread pools when it is first imported.
+    threads = getattr(args, "threads", None) or os.environ.get("TF_INTRA_OP_THREADS")
+    if threads:
+        os.environ["TF_INTRA_OP_THREADS"] = str(threads)
+        os.environ["TF_INTER_OP_THREADS"] = str(threads)
+    os.environ.pop("EMBEDDING_CACHE_DIR", None)
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+
+    if args.command == "time-startup":
+        print(time_startup())
+        return
+
+    baseline = None
+    if args.baseline:
+        # Checked before the benchmarks, which take minutes, and read first,
+        # in case --save-baseline replaces the same file.
+        if not os.path.exists(args.baseline):
+            parser.error(
+                f"baseline {args.baseline} not found; record one with --save-baseline"
+            )
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = run(args.only, args.repeats, args.threads, args.batch_sizes)
+    text = json.dumps(report, indent=2)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+    print(text)
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(
+                f"FAILED: {len(regressions)} benchmark(s) regressed by more than "
+                f"{args.tolerance:.0%}: {', '.join(regressions)}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
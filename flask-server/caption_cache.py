@@ -0,0 +1,267 @@
+import io
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import numpy as np
+from PIL import Image
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_hash TEXT NOT NULL,
+    phash INTEGER,
+    options TEXT NOT NULL,
+    model_version TEXT NOT NULL,
+    captions TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    UNIQUE (image_hash, options, model_version)
+);
+CREATE INDEX IF NOT EXISTS captions_accessed_at ON captions (accessed_at);
+"""
+MAX_DISTANCE = 4  # differing bits between near-duplicate perceptual hashes
+MIN_HASH_BITS = 8  # flat images hash to (almost) all zeros or all ones
+TOUCH_SECONDS = 60  # accessed_at is updated at most this often per entry
+EVICT_EVERY = 100  # stores between two checks of the size budget
+
+
+def perceptual_hash(data):
+    # 64-bit difference hash: whether brightness increases between adjacent
+    # pixels of a 9x8 grayscale thumbnail. Recompression, resizing and small
+    # color changes flip only a few bits.
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("L", (64, 64))
+        pixels = np.asarray(
+            img.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=np.int16
+        )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming_distances(hashes, phash):
+    # Set bits of hashes XOR phash, counted in parallel within each word.
+    x = np.bitwise_xor(hashes, np.uint64(phash))
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + (
+        (x >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def options_key(options):
+    return json.dumps(options, sort_keys=True)
+
+
+def connect(path, timeout=30):
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")  # a lost entry is recomputed
+    return connection
+
+
+class CaptionCache:
+    """Captions by image and decoding options, in a SQLite database.
+
+    An entry is found by the SHA-256 of the image bytes or, for a
+    recompressed or resized copy of a cached image, by a perceptual hash
+    within MAX_DISTANCE bits. Each process keeps the perceptual hashes in
+    a numpy array, compared all at once, and picks up entries written by
+    other processes on its next lookup.
+
+    Entries expire ttl seconds after they were computed, and the least
+    recently used ones are deleted while the captions exceed max_bytes.
+    Every entry records the model version it was computed with; entries of
+    any other version are never returned and are deleted as soon as a
+    newer version is seen, e.g. after fine-tuning.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._version = None
+        self._reset_index()
+        self._stores = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+        with closing(connect(path)) as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections belong to the thread that opened them.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = connect(self.path)
+            self._local.connection = connection
+        return connection
+
+    def _use_version(self, version):
+        # Called with self._lock held.
+        version = version or ""
+        if version == self._version:
+            return version
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM captions WHERE model_version != ?", (version,)
+            )
+        self._version = version
+        self._reset_index()
+        return version
+
+    def _reset_index(self):
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._phashes = np.zeros(0, dtype=np.uint64)
+        self._options = []
+        self._last_id = 0
+
+    def _refresh(self, version):
+        # Adds entries stored since the last lookup, by any process.
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT id, phash, options FROM captions"
+                " WHERE id > ? AND model_version = ? AND phash IS NOT NULL",
+                (self._last_id, version),
+            )
+            .fetchall()
+        )
+        if not rows:
+            return
+        ids, phashes, options = zip(*rows)
+        self._ids = np.concatenate([self._ids, np.array(ids, dtype=np.int64)])
+        self._phashes = np.concatenate(
+            [self._phashes, np.array(phashes, dtype=np.int64).view(np.uint64)]
+        )
+        self._options.extend(options)
+        self._last_id = max(self._last_id, ids[-1])
+
+    def _nearest(self, phash, options):
+        # Entry IDs of perceptually similar images, closest first.
+        if not MIN_HASH_BITS <= bin(phash).count("1") <= 64 - MIN_HASH_BITS:
+            return []
+        distances = hamming_distances(self._phashes, phash)
+        candidates = np.flatnonzero(distances <= MAX_DISTANCE)
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [int(self._ids[i]) for i in candidates if self._options[i] == options]
+
+    def get(self, image_hash, phash, options, version):
+        options = options_key(options)
+        expired = time.time() - self.ttl
+        with self._lock:
+            version = self._use_version(version)
+            self._refresh(version)
+            near = self._nearest(phash, options) if phash is not None else []
+
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT id, captions, accessed_at FROM captions WHERE image_hash = ?"
+            " AND options = ? AND model_version = ? AND created_at > ?",
+            (image_hash, options, version, expired),
+        ).fetchone()
+        exact = row is not None
+        for entry_id in near if row is None else []:
+            row = connection.execute(
+                "SELECT id, captions, accessed_at FROM captions"
+                " WHERE id = ? AND created_at > ?",
+                (entry_id, expired),
+            ).fetchone()
+            if row is not None:
+                break
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            if exact:
+                self.hits += 1
+            else:
+                self.near_hits += 1
+        entry_id, captions, accessed_at = row
+        now = time.time()
+        if now - accessed_at > TOUCH_SECONDS:
+            with connection:
+                connection.execute(
+                    "UPDATE captions SET accessed_at = ? WHERE id = ?", (now, entry_id)
+                )
+        return json.loads(captions)
+
+    def put(self, image_hash, phash, options, version, captions):
+        captions = json.dumps(captions)
+        now = time.time()
+        with self._lock:
+            version = self._use_version(version)
+            self._stores += 1
+            evict = self._stores % EVICT_EVERY == 1
+        if phash is not None and phash >= 2**63:
+            phash -= 2**64  # SQLite integers are signed
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO captions (image_hash, phash, options,"
+                " model_version, captions, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    image_hash,
+                    phash,
+                    options_key(options),
+                    version,
+                    captions,
+                    len(captions),
+                    now,
+                    now,
+                ),
+            )
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # Deletes expired entries, then the least recently used ones until
+        # the captions fit into max_bytes.
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM captions WHERE created_at <= ?", (time.time() - self.ttl,)
+            )
+            total = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM captions"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            cutoff = None
+            for accessed_at, size in connection.execute(
+                "SELECT accessed_at, size FROM captions ORDER BY accessed_at"
+            ):
+                total -= size
+                cutoff = accessed_at
+                if total <= self.max_bytes:
+                    break
+            connection.execute("DELETE FROM captions WHERE accessed_at <= ?", (cutoff,))
+        with self._lock:
+            # Evicted perceptual hashes would only cost a lookup each; start
+            # over so the array does not keep growing.
+            self._reset_index()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+            }
+        entries, size = (
+            self._connection()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM captions")
+            .fetchone()
+        )
+        return dict(stats, entries=entries, bytes=size)
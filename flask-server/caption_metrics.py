@@ -0,0 +1,157 @@
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+MAX_N = 4
+CIDER_SIGMA = 6.0
+METEOR_ALPHA = 0.9
+METEOR_BETA = 3.0
+METEOR_GAMMA = 0.5
+
+
+def tokenize(caption):
+    # The standardization preprocess_caption applies to training captions.
+    caption = re.sub(r"[^\w\s]", "", caption.lower())
+    return caption.split()
+
+
+def ngrams(tokens, n):
+    return Counter(tuple(tokens[i : i + n]) for i in range(len(tokens) - n + 1))
+
+
+def corpus_bleu(candidates, references, max_n=MAX_N):
+    # Corpus-level BLEU-1..max_n with clipped n-gram counts and the brevity
+    # penalty against the closest reference length, without smoothing.
+    matches = [0] * max_n
+    totals = [0] * max_n
+    candidate_length = 0
+    reference_length = 0
+    for candidate, refs in zip(candidates, references):
+        candidate_length += len(candidate)
+        reference_length += min(
+            (len(ref) for ref in refs),
+            key=lambda length: (abs(length - len(candidate)), length),
+        )
+        for n in range(1, max_n + 1):
+            counts = ngrams(candidate, n)
+            max_ref_counts = Counter()
+            for ref in refs:
+                max_ref_counts |= ngrams(ref, n)
+            matches[n - 1] += sum((counts & max_ref_counts).values())
+            totals[n - 1] += sum(counts.values())
+
+    if candidate_length == 0:
+        return [0.0] * max_n
+    brevity = min(1.0, math.exp(1 - reference_length / candidate_length))
+    scores = []
+    log_precision = 0.0
+    for n in range(max_n):
+        if matches[n] == 0:
+            scores.extend([0.0] * (max_n - n))
+            break
+        log_precision += math.log(matches[n] / totals[n])
+        scores.append(brevity * math.exp(log_precision / (n + 1)))
+    return scores
+
+
+def _cider_vectors(tokens, document_frequency, log_documents):
+    vectors = []
+    norms = []
+    for n in range(1, MAX_N + 1):
+        vector = {
+            gram: count * (log_documents - math.log(max(1.0, document_frequency[gram])))
+            for gram, count in ngrams(tokens, n).items()
+        }
+        vectors.append(vector)
+        norms.append(math.sqrt(sum(value * value for value in vector.values())))
+    return vectors, norms
+
+
+def cider_d(candidates, references):
+    # CIDEr-D: TF-IDF weighted n-gram cosine similarity to each reference,
+    # with clipped candidate weights and a Gaussian length penalty. Document
+    # frequencies come from the reference sets of the evaluated images.
+    document_frequency = Counter()
+    for refs in references:
+        document_frequency.update(
+            {
+                gram
+                for ref in refs
+                for n in range(1, MAX_N + 1)
+                for gram in ngrams(ref, n)
+            }
+        )
+    log_documents = math.log(max(1, len(references)))
+
+    scores = []
+    for candidate, refs in zip(candidates, references):
+        vectors, norms = _cider_vectors(candidate, document_frequency, log_documents)
+        score = np.zeros(MAX_N)
+        for ref in refs:
+            ref_vectors, ref_norms = _cider_vectors(
+                ref, document_frequency, log_documents
+            )
+            delta = len(candidate) - len(ref)
+            penalty = math.exp(-(delta**2) / (2 * CIDER_SIGMA**2))
+            for n in range(MAX_N):
+                if not norms[n] or not ref_norms[n]:
+                    continue
+                overlap = sum(
+                    min(value, ref_vectors[n].get(gram, 0.0))
+                    * ref_vectors[n].get(gram, 0.0)
+                    for gram, value in vectors[n].items()
+                )
+                score[n] += overlap / (norms[n] * ref_norms[n]) * penalty
+        scores.append(10.0 * score.mean() / max(1, len(refs)))
+    return float(np.mean(scores)) if scores else 0.0, scores
+
+
+def _meteor_single(candidate, ref):
+    # Exact unigram matches aligned left to right.
+    unused = {}
+    for position, token in enumerate(ref):
+        unused.setdefault(token, []).append(position)
+    alignment = []
+    for position, token in enumerate(candidate):
+        if unused.get(token):
+            alignment.append((position, unused[token].pop(0)))
+    matches = len(alignment)
+    if not matches:
+        return 0.0
+
+    precision = matches / len(candidate)
+    recall = matches / len(ref)
+    fmean = (
+        precision * recall / (METEOR_ALPHA * precision + (1 - METEOR_ALPHA) * recall)
+    )
+    chunks = 1 + sum(
+        1
+        for (c1, r1), (c2, r2) in zip(alignment, alignment[1:])
+        if c2 != c1 + 1 or r2 != r1 + 1
+    )
+    penalty = METEOR_GAMMA * (chunks / matches) ** METEOR_BETA
+    return fmean * (1 - penalty)
+
+
+def meteor_like(candidates, references):
+    # METEOR with exact matching only (no stemming or synonyms), scored
+    # against the best reference of each image.
+    scores = [
+        max((_meteor_single(candidate, ref) for ref in refs), default=0.0)
+        for candidate, refs in zip(candidates, references)
+    ]
+    return float(np.mean(scores)) if scores else 0.0, scores
+
+
+def caption_scores(captions, references):
+    # captions: one string per image; references: a list of strings per image.
+    candidates = [tokenize(caption) for caption in captions]
+    references = [[tokenize(ref) for ref in refs] for refs in references]
+    bleu = corpus_bleu(candidates, references)
+    cider, cider_per_image = cider_d(candidates, references)
+    meteor, meteor_per_image = meteor_like(candidates, references)
+    scores = {f"bleu_{n}": score for n, score in enumerate(bleu, 1)}
+    scores.update(cider=cider, meteor=meteor)
+    return scores, {"cider": cider_per_image, "meteor": meteor_per_image}
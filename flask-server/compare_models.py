@@ -1,97 +1,230 @@
+"""Compares caption models on a held-out set of captioned images.
+
+    python compare_models.py [--report PATH] evaluate MANIFEST [--models base latest]
+    streamlit run compare_models.py -- [--report PATH]
+
+MANIFEST is a JSON lines file with an "image" and a "caption" or
+"captions" per line, a COCO captions JSON file (images are looked up in
+--image-dir), or a feedback database, whose records after --since are
+grouped per image. A model is "base" (the released weights), "latest"
+(with the latest fine-tuning) or the path of a fine-tuning checkpoint.
+
+cnn_model is never fine-tuned, so its features are extracted once into a
+feature store and shared by all models and by later runs; each model then
+only runs its encoder and batched greedy decoding. The report holds the
+scores, the decoding latency and every caption, and the Streamlit page
+renders it without running any model.
+"""
+
+import argparse
+import json
 import os
-import numpy as np
-import matplotlib.pyplot as plt
-import tensorflow as tf
-from tensorflow.keras.models import load_model as tf_load_model
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-import streamlit as st
-
-# Constants
-NUM_SAMPLES = 100
-IMAGE_SIZE = (256, 256)
-
-# Path definitions
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-MODEL_PATH_CURRENT = os.path.join(
-    SCRIPT_DIR, "saved_models", "image_captioning_coco_model.h5"
-)
-MODEL_PATH_UPDATED = os.path.join(
-    SCRIPT_DIR, "saved_models", "image_captioning_updated_model.h5"
-)
-
-
-def generate_synthetic_data(num_samples, image_size=(256, 256)):
-    synthetic_images = np.random.random((num_samples, *image_size, 3))
-    synthetic_labels = np.random.randint(0, 2, num_samples)
-    return synthetic_images, synthetic_labels
-
-
-def create_synthetic_data_generator(num_samples, image_size=(256, 256)):
-    synthetic_images, synthetic_labels = generate_synthetic_data(
-        num_samples, image_size
-    )
-    datagen = ImageDataGenerator(rescale=1.0 / 255)
-    generator = datagen.flow(synthetic_images, synthetic_labels, batch_size=32)
-    return generator
-
-
-def load_models(current_model_path, updated_model_path):
-    if not os.path.isfile(current_model_path):
-        raise FileNotFoundError(f"Current model file not found: {current_model_path}")
-    if not os.path.isfile(updated_model_path):
-        raise FileNotFoundError(f"Updated model file not found: {updated_model_path}")
-
-    try:
-        model_current = tf_load_model(current_model_path)
-        model_updated = tf_load_model(updated_model_path)
-    except Exception as e:
-        raise RuntimeError(f"Error loading models: {e}")
-
-    return model_current, model_updated
-
-
-def evaluate_model(model, data_generator):
-    loss, accuracy = model.evaluate(data_generator, verbose=0)
-    return accuracy
-
-
-def plot_comparison(accuracy_current, accuracy_updated):
-    labels = ["Current Model", "Updated Model"]
-    accuracies = [accuracy_current, accuracy_updated]
-    fig, ax = plt.subplots(figsize=(8, 6))
-    ax.bar(labels, accuracies, color=["blue", "green"])
-    ax.set_xlabel("Model")
-    ax.set_ylabel("Accuracy")
-    ax.set_title("Model Comparison")
-    ax.set_ylim(0, 1)
-    st.pyplot(fig)
+import sys
+import time
+from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+
+from caption_metrics import caption_scores
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_PATH = os.path.join(ROOT_DIR, "compare_report.json")
+FEATURES_DIR = os.path.join(ROOT_DIR, "saved_models", "features")
+BATCH_SIZE = 32
+
+
+def load_references(source, image_dir=None, since=0):
+    # Returns {image path: [reference captions]} in manifest order.
+    references = defaultdict(list)
+    base = os.path.dirname(os.path.abspath(source))
+
+    if source.endswith(".db"):
+        from feedback_store import FeedbackStore
+        from retrain_model import resolve_image_path
+
+        for record in FeedbackStore(source).iter_since(since):
+            references[resolve_image_path(record.image_path)].append(record.caption)
+    elif source.endswith(".json"):
+        with open(source) as f:
+            coco = json.load(f)
+        image_dir = image_dir or base
+        files = {
+            image["id"]: os.path.join(image_dir, image["file_name"])
+            for image in coco["images"]
+        }
+        for annotation in coco["annotations"]:
+            references[files[annotation["image_id"]]].append(annotation["caption"])
+    else:
+        image_dir = image_dir or base
+        with open(source) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                captions = entry.get("captions") or [entry["caption"]]
+                path = os.path.join(image_dir, entry["image"])
+                references[path].extend(captions)
+    return dict(references)
+
+
+def load_model(spec):
+    from model import get_caption_model
+
+    if spec == "base":
+        return get_caption_model(finetuned=False)
+    if spec == "latest":
+        return get_caption_model()
+    return get_caption_model(finetuned=spec)
+
+
+def caption_features(caption_model, store, paths, batch_size=BATCH_SIZE):
+    # Greedy captions for every path from its stored cnn_model features,
+    # plus the seconds spent in the encoder and the decoder.
+    from model import greedy_captions
+
+    captions = []
+    seconds = 0.0
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start : start + batch_size]
+        img_embed = np.stack([store.features(path) for path in batch])
+        started = time.perf_counter()
+        img_encoded = caption_model.encoder(
+            img_embed.astype(np.float32), training=False
+        )
+        captions.extend(greedy_captions(caption_model, img_encoded))
+        seconds += time.perf_counter() - started
+    return captions, seconds
+
+
+def evaluate(models, references, store, batch_size=BATCH_SIZE):
+    # models: {name: caption model}. Features missing from the store are
+    # extracted with the first model's cnn_model.
+    from feature_store import extract_features
+
+    first = next(iter(models.values()))
+    extraction = extract_features(store, list(references), first.cnn_model, batch_size)
+    paths = [path for path in references if path in store.paths]
+    refs = [references[path] for path in paths]
+
+    report = {
+        "images": len(paths),
+        "skipped_images": len(references) - len(paths),
+        "references": sum(len(r) for r in refs),
+        "features": extraction,
+        "models": {},
+        "examples": [
+            {"image": path, "references": r, "captions": {}, "cider": {}}
+            for path, r in zip(paths, refs)
+        ],
+    }
+    for name, caption_model in models.items():
+        captions, seconds = caption_features(caption_model, store, paths, batch_size)
+        scores, per_image = caption_scores(captions, refs)
+        report["models"][name] = {
+            "scores": scores,
+            "latency": {
+                "seconds": seconds,
+                "ms_per_image": 1000 * seconds / len(paths) if paths else 0.0,
+                "images_per_second": len(paths) / seconds if seconds else 0.0,
+            },
+        }
+        for example, caption, cider in zip(
+            report["examples"], captions, per_image["cider"]
+        ):
+            example["captions"][name] = caption
+            example["cider"][name] = cider
+    return report
+
+
+def render_report(path):
+    import streamlit as st
 
-def main():
     st.title("Model Comparison")
-
-    # Load models and evaluate
-    try:
-        model_current, model_updated = load_models(
-            MODEL_PATH_CURRENT, MODEL_PATH_UPDATED
+    if not os.path.exists(path):
+        st.info(
+            "No report yet. Create one with: "
+            "python compare_models.py evaluate MANIFEST --report " + path
         )
-        data_generator = create_synthetic_data_generator(NUM_SAMPLES, IMAGE_SIZE)
-
-        accuracy_current = evaluate_model(model_current, data_generator)
-        accuracy_updated = evaluate_model(model_updated, data_generator)
-
-        st.write(f"Current Model Accuracy: {accuracy_current:.2f}")
-        st.write(f"Updated Model Accuracy: {accuracy_updated:.2f}")
+        return
+    with open(path) as f:
+        report = json.load(f)
+
+    st.write(
+        f"{report['images']} images with {report['references']} reference "
+        f"captions from {report['source']} "
+        f"({report['skipped_images']} skipped), evaluated {report['created_at']}."
+    )
+    scores = pd.DataFrame(
+        {name: model["scores"] for name, model in report["models"].items()}
+    ).T
+    st.subheader("Scores")
+    st.dataframe(scores.round(3))
+    st.bar_chart(scores[["bleu_4", "meteor", "cider"]].T)
+
+    st.subheader("Decoding latency")
+    latency = pd.DataFrame(
+        {name: model["latency"] for name, model in report["models"].items()}
+    ).T
+    st.dataframe(latency[["ms_per_image", "images_per_second"]])
+
+    st.subheader("Captions")
+    names = list(report["models"])
+    examples = report["examples"]
+    if len(names) >= 2:
+        # Largest CIDEr differences between the first two models first
+        examples = sorted(
+            examples,
+            key=lambda e: abs(e["cider"][names[1]] - e["cider"][names[0]]),
+            reverse=True,
+        )
+    count = st.slider("Images", 1, max(1, len(examples)), min(10, len(examples)))
+    for example in examples[:count]:
+        image, text = st.columns([1, 2])
+        if os.path.exists(example["image"]):
+            image.image(example["image"])
+        for name in names:
+            text.markdown(
+                f"**{name}** ({example['cider'][name]:.2f}): "
+                f"{example['captions'][name]}"
+            )
+        text.caption(" / ".join(example["references"]))
 
-        # Plot comparison
-        plot_comparison(accuracy_current, accuracy_updated)
 
-    except FileNotFoundError as e:
-        st.error(f"Error: {e}")
-    except RuntimeError as e:
-        st.error(f"Runtime error: {e}")
-    except Exception as e:
-        st.error(f"An unexpected error occurred: {e}")
+def main():
+    parser = argparse.ArgumentParser(description="Caption model comparison")
+    parser.add_argument("--report", default=REPORT_PATH)
+    subparsers = parser.add_subparsers(dest="command")
+    evaluate_parser = subparsers.add_parser("evaluate", help="write a report")
+    evaluate_parser.add_argument("manifest")
+    evaluate_parser.add_argument("--models", nargs="+", default=["base", "latest"])
+    evaluate_parser.add_argument("--image-dir")
+    evaluate_parser.add_argument("--since", type=int, default=0)
+    evaluate_parser.add_argument("--limit", type=int)
+    evaluate_parser.add_argument("--features", default=FEATURES_DIR)
+    evaluate_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command is None:
+        # The local streamlit.py would shadow the package outside its runner.
+        if "streamlit" not in sys.modules:
+            parser.error("render the report with: streamlit run compare_models.py")
+        render_report(args.report)
+        return
+
+    from feature_store import FeatureStore
+
+    references = load_references(args.manifest, args.image_dir, args.since)
+    if args.limit:
+        references = dict(list(references.items())[: args.limit])
+    models = {spec: load_model(spec) for spec in args.models}
+    report = evaluate(models, references, FeatureStore(args.features), args.batch_size)
+    report.update(source=args.manifest, created_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, model in report["models"].items():
+        print(name, json.dumps(model))
+    print(f"Report written to {args.report}")
 
 
 if __name__ == "__main__":
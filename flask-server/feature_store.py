@@ -0,0 +1,297 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from embedding_cache import content_hash
+from model import BATCH_SIZE, BUFFER_SIZE, decode_image, preprocess_caption, tokenizer
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+FEATURE_SHAPE = (64, 2048)  # cnn_model output for a 299x299 image
+SHARD_SIZE = 1024  # rows per shard file, 256 MiB at float16
+
+
+class FeatureStore:
+    """cnn_model embeddings stored as fixed-size float16 .npy shards.
+
+    Every unique image (by content hash) gets one row; index.jsonl maps each
+    extracted path to its hash, shard and row. Shards are memory-mapped, so
+    training reads only the rows it needs. Rows are flushed to disk before
+    their index lines are appended, which makes an interrupted extraction
+    safe to resume: paths without an index line are simply extracted again.
+    """
+
+    def __init__(self, directory, shard_size=SHARD_SIZE):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, "meta.json")
+        meta = {
+            "shard_size": shard_size,
+            "feature_shape": list(FEATURE_SHAPE),
+            "dtype": "float16",
+        }
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+        self.shard_size = meta["shard_size"]
+        self.feature_shape = tuple(meta["feature_shape"])
+
+        self.paths = {}  # path -> (hash, shard, row)
+        self.hashes = {}  # hash -> (shard, row)
+        self._next_row = 0
+        self._index_path = os.path.join(directory, "index.jsonl")
+        if os.path.exists(self._index_path):
+            self._load_index()
+
+        self._shards = {}
+
+    def _load_index(self):
+        # A line cut short by a crash is removed, so that the next append
+        # starts on a clean line boundary instead of being glued onto it.
+        valid_bytes = 0
+        with open(self._index_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                valid_bytes += len(line)
+                location = (entry["shard"], entry["row"])
+                self.paths[entry["path"]] = (entry["hash"],) + location
+                self.hashes[entry["hash"]] = location
+                self._next_row = max(
+                    self._next_row, location[0] * self.shard_size + location[1] + 1
+                )
+        with open(self._index_path, "r+b") as f:
+            f.truncate(valid_bytes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f"shard-{shard:05d}.npy")
+
+    def shard(self, shard, mode="r"):
+        array = self._shards.get(shard)
+        if array is None or (mode != "r" and array.mode == "r"):
+            path = self._shard_path(shard)
+            if mode == "r+" and not os.path.exists(path):
+                array = np.lib.format.open_memmap(
+                    path,
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(self.shard_size,) + self.feature_shape,
+                )
+            else:
+                array = np.load(path, mmap_mode=mode)
+            self._shards[shard] = array
+        return array
+
+    def add(self, entries, features):
+        # entries: (path, hash) pairs; features: one embedding per new hash
+        # in order of first appearance. Already stored hashes only get an
+        # index line pointing at the existing row.
+        features = iter(features)
+        lines = []
+        touched = set()
+        for path, key in entries:
+            location = self.hashes.get(key)
+            if location is None:
+                # After the highest indexed row, never a row already in use
+                location = divmod(self._next_row, self.shard_size)
+                self._next_row += 1
+                self.shard(location[0], "r+")[location[1]] = next(features)
+                self.hashes[key] = location
+                touched.add(location[0])
+            self.paths[path] = (key,) + location
+            lines.append(
+                json.dumps(
+                    {
+                        "path": path,
+                        "hash": key,
+                        "shard": location[0],
+                        "row": location[1],
+                    }
+                )
+            )
+
+        for shard in touched:
+            self._shards[shard].flush()
+        with open(self._index_path, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def features(self, path):
+        _, shard, row = self.paths[path]
+        return self.shard(shard)[row]
+
+    def read(self, shards, rows):
+        return np.stack(
+            [self.shard(shard)[row] for shard, row in zip(shards, rows)]
+        ).astype(np.float32)
+
+    def dataset(self, paths, captions, batch_size=BATCH_SIZE, shuffle=True):
+        # (embeddings, token IDs) batches for ImageCaptioningModel.fit, read
+        # from the shards instead of decoding and embedding images.
+        shards, rows = zip(*(self.paths[path][1:] for path in paths))
+        token_ids = tokenizer([preprocess_caption(c) for c in captions])
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (np.array(shards), np.array(rows), token_ids)
+        )
+        if shuffle:
+            dataset = dataset.shuffle(BUFFER_SIZE)
+
+        def load(shards, rows, token_ids):
+            img_embed = tf.numpy_function(
+                self.read, [shards, rows], tf.float32, stateful=False
+            )
+            img_embed.set_shape((None,) + self.feature_shape)
+            return img_embed, token_ids
+
+        return (
+            dataset.batch(batch_size)
+            .map(load, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+
+
+def list_images(source):
+    # A directory (searched recursively), or a manifest: JSON lines with an
+    # "image" key, or one path or URL per line. Relative manifest paths are
+    # resolved against the manifest's directory.
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "**", "*"), recursive=True)
+        return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            path = json.loads(line)["image"] if line.startswith("{") else line
+            paths.append(path if "://" in path else os.path.join(base, path))
+    return paths
+
+
+def read_new_images(store, paths, counts, duplicates):
+    # Yields (path, hash, bytes) for images not indexed yet. Paths whose
+    # content is already stored or queued are collected in duplicates and
+    # indexed once extraction is done, without running cnn_model again.
+    seen = set()
+    for path in paths:
+        if path in store.paths:
+            counts["indexed"] += 1
+            continue
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            counts["unreadable"] += 1
+            continue
+        key = content_hash(data)
+        if key in store.hashes or key in seen:
+            duplicates.append((path, key))
+            continue
+        seen.add(key)
+        counts["queued"] += 1
+        yield path, key, data
+
+
+def extract_features(store, paths, cnn_model, batch_size=BATCH_SIZE):
+    counts = {"indexed": 0, "unreadable": 0, "queued": 0}
+    duplicates = []
+    dataset = tf.data.Dataset.from_generator(
+        lambda: read_new_images(store, paths, counts, duplicates),
+        output_signature=(
+            tf.TensorSpec((), tf.string),
+            tf.TensorSpec((), tf.string),
+            tf.TensorSpec((), tf.string),
+        ),
+    )
+    dataset = (
+        dataset.map(
+            lambda path, key, data: (path, key, decode_image(data)),
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=False,
+        )
+        .ignore_errors()  # undecodable images
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+    started = time.perf_counter()
+    extracted = 0
+    for path, key, imgs in dataset:
+        features = cnn_model(imgs, training=False).numpy().astype(np.float16)
+        entries = [(p.decode(), k.decode()) for p, k in zip(path.numpy(), key.numpy())]
+        store.add(entries, features)
+        extracted += len(entries)
+    # Duplicates of images that failed to decode stay unindexed.
+    store.add([entry for entry in duplicates if entry[1] in store.hashes], [])
+    seconds = time.perf_counter() - started
+
+    return {
+        "extracted": extracted,
+        "already_indexed": counts["indexed"],
+        "duplicates": len(duplicates),
+        "unreadable": counts["unreadable"],
+        "undecodable": counts["queued"] - extracted,
+        "unique_images": len(store),
+        "seconds": seconds,
+        "images_per_second": extracted / seconds if seconds else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline cnn_model feature store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    extract_parser = subparsers.add_parser(
+        "extract", help="extract features of a directory or manifest of images"
+    )
+    extract_parser.add_argument("source")
+    extract_parser.add_argument("--output", required=True)
+    extract_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    extract_parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    stats_parser = subparsers.add_parser("stats", help="describe a feature store")
+    stats_parser.add_argument("store")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        from serving_model import load_caption_model
+
+        store = FeatureStore(args.output, args.shard_size)
+        caption_model = load_caption_model()
+        report = extract_features(
+            store, list_images(args.source), caption_model.cnn_model, args.batch_size
+        )
+        print(json.dumps(report, indent=2))
+    else:
+        store = FeatureStore(args.store)
+        print(
+            json.dumps(
+                {
+                    "paths": len(store.paths),
+                    "unique_images": len(store),
+                    "shard_size": store.shard_size,
+                    "shards": len({shard for shard, _ in store.hashes.values()}),
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import closing
+
+Feedback = namedtuple(
+    "Feedback", ["id", "created_at", "image_hash", "image_path", "caption"]
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    image_hash TEXT,
+    image_path TEXT NOT NULL,
+    caption TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_image_hash ON feedback (image_hash);
+"""
+WRITE_TIMEOUT = 60  # seconds add() waits for its commit; connect waits 30
+
+
+def connect(path, timeout=30):
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # FULL syncs the WAL on every commit, so a record whose future has
+    # resolved survives a power loss; group commits keep that affordable.
+    connection.execute("PRAGMA synchronous=FULL")
+    return connection
+
+
+class FeedbackStore:
+    """User feedback in a SQLite database in WAL mode.
+
+    Writes from all request threads go through one writer thread. Records
+    that queue up while a transaction is being committed are written
+    together in the next one (a group commit), so concurrent confirmations
+    share one fsync. Several processes may use
+    the same file; SQLite serializes their transactions. Readers never block
+    the writer.
+    """
+
+    def __init__(self, path, max_batch_size=256, max_delay_ms=0):
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._local = threading.local()
+        self.commits = 0
+        self.records = 0
+
+        with closing(connect(path)) as connection:
+            connection.executescript(SCHEMA)
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="feedback-writer", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, image_path, caption, image_hash=None):
+        # The future resolves to the record ID once its transaction commits.
+        future = Future()
+        row = (time.time(), image_hash, image_path, caption)
+        with self._condition:
+            self._queue.append((row, future))
+            self._condition.notify()
+        self.start()
+        return future
+
+    def add(self, image_path, caption, image_hash=None, timeout=WRITE_TIMEOUT):
+        return self.submit(image_path, caption, image_hash).result(timeout)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            # An optional delay lets concurrent writers join this transaction.
+            deadline = time.perf_counter() + self.max_delay
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._queue[: self.max_batch_size]
+            del self._queue[: self.max_batch_size]
+            return batch
+
+    def _run(self):
+        connection = None
+        while True:
+            batch = self._next_batch()
+            try:
+                # Opened here, so that a database that cannot be opened fails
+                # the batch instead of the thread; the next batch retries.
+                if connection is None:
+                    connection = connect(self.path)
+                with connection:
+                    ids = [
+                        connection.execute(
+                            "INSERT INTO feedback"
+                            " (created_at, image_hash, image_path, caption)"
+                            " VALUES (?, ?, ?, ?)",
+                            row,
+                        ).lastrowid
+                        for row, _ in batch
+                    ]
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._condition:
+                self.commits += 1
+                self.records += len(batch)
+            for (_, future), record_id in zip(batch, ids):
+                future.set_result(record_id)
+
+    def _connection(self):
+        # sqlite3 connections belong to the thread that opened them.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = connect(self.path)
+            self._local.connection = connection
+        return connection
+
+    def by_image_hash(self, image_hash):
+        rows = self._connection().execute(
+            "SELECT * FROM feedback WHERE image_hash = ? ORDER BY id", (image_hash,)
+        )
+        return [Feedback(*row) for row in rows]
+
+    def iter_since(self, offset=0, batch_size=1000):
+        # Yields records with an ID greater than offset, oldest first. The
+        # last yielded ID is the offset to resume from next time.
+        connection = self._connection()
+        while True:
+            rows = connection.execute(
+                "SELECT * FROM feedback WHERE id > ? ORDER BY id LIMIT ?",
+                (offset, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield Feedback(*row)
+            offset = rows[-1][0]
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+
+    def stats(self):
+        with self._condition:
+            return {
+                "records": self.count(),
+                "pending_writes": len(self._queue),
+                "commits": self.commits,
+                "mean_commit_size": (
+                    self.records / self.commits if self.commits else 0.0
+                ),
+            }
+
+
+def import_csv(store, path):
+    # The legacy file has no header and unquoted captions, but image paths
+    # never contain commas, so everything after the first comma is the caption.
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = [line.rstrip("\r\n").split(",", 1) for line in f if "," in line]
+    futures = [store.submit(image_path, caption) for image_path, caption in rows]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def export_csv(store, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(Feedback._fields)
+        for record in store.iter_since(0):
+            writer.writerow(record)
+
+
+def _insert_one(path, row):
+    connection = connect(path)
+    with connection:
+        connection.execute(
+            "INSERT INTO feedback (created_at, image_hash, image_path, caption)"
+            " VALUES (?, ?, ?, ?)",
+            row,
+        )
+    connection.close()
+
+
+def _write_concurrently(write, records, threads):
+    per_thread = records // threads
+    workers = [
+        threading.Thread(target=lambda: [write() for _ in range(per_thread)])
+        for _ in range(threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def benchmark(records=2000, threads=16):
+    # Concurrent writers committing one record each (the old append pattern)
+    # against the same writers going through the group-committing store.
+    row = (time.time(), None, "image.jpg", "a man riding a surfboard")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "single.db")
+        with closing(connect(path)) as connection:
+            connection.executescript(SCHEMA)
+        results["commit_per_record_per_second"] = _write_concurrently(
+            lambda: _insert_one(path, row), records, threads
+        )
+
+        store = FeedbackStore(os.path.join(directory, "grouped.db"))
+        results["group_commit_per_second"] = _write_concurrently(
+            lambda: store.add(*row[2:]), records, threads
+        )
+        results.update(store.stats())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User feedback store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import the legacy CSV")
+    import_parser.add_argument("database")
+    import_parser.add_argument("csv")
+    export_parser = subparsers.add_parser("export", help="export to CSV")
+    export_parser.add_argument("database")
+    export_parser.add_argument("csv")
+    benchmark_parser = subparsers.add_parser("benchmark", help="commit throughput")
+    benchmark_parser.add_argument("--records", type=int, default=2000)
+    benchmark_parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        count = import_csv(FeedbackStore(args.database), args.csv)
+        print(f"Imported {count} records into {args.database}")
+    elif args.command == "export":
+        export_csv(FeedbackStore(args.database), args.csv)
+        print(f"Exported {args.database} to {args.csv}")
+    else:
+        print(json.dumps(benchmark(args.records, args.threads), indent=2))
+
+
+if __name__ == "__main__":
+    main()
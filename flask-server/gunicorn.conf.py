@@ -0,0 +1,148 @@
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+#
+# Settings come from the environment:
+#   PORT                 listen port (8501)
+#   SERVING_CORES        CPU cores for the whole server (all available ones)
+#   WEB_CONCURRENCY      worker processes (SERVING_CORES // 4, at least 1)
+#   WEB_THREADS          request threads per worker (8)
+#   TF_INTRA_OP_THREADS  TensorFlow threads per op (SERVING_CORES // workers)
+#   TF_INTER_OP_THREADS  ops run concurrently per worker (2)
+#   WORKER_TIMEOUT       seconds before a silent worker is restarted (120)
+#   TFLITE_MODEL_DIR     serve a TFLite export (tflite_model.py) instead
+#                        (fine-tuning reaches it only when exported again)
+#   METRICS_DIR          where workers share their /metrics (a temp directory)
+#   DATA_DIR             uploads and databases (this directory)
+#   BATCH_INPUT_DIR      images /batch may caption by directory or manifest
+#                        (disabled)
+#
+# TensorFlow is not fork-safe: a child forked after the parent ran an op
+# inherits thread pools whose threads are gone and hangs on its first
+# inference. The master therefore never imports TensorFlow. Before forking
+# it reads the weight files into the page cache, which all workers share, so
+# N workers starting together read the disk once; each worker then builds
+# its own model. TFLite models are memory-mapped straight from that cache.
+#
+# Workers only take requests once their model is loaded and warmed up.
+# serving_benchmark.py measures throughput for different worker counts.
+import glob
+import os
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SAVED_MODELS_DIR = os.path.join(ROOT_DIR, "saved_models")
+
+if hasattr(os, "sched_getaffinity"):
+    available_cores = len(os.sched_getaffinity(0))
+else:
+    available_cores = os.cpu_count()
+# Measured with serving_benchmark.py on a 1-core machine, dynamic-range TFLite
+# model, 8 request threads, 4 concurrent clients sending distinct images:
+#   1 worker:  3.4 req/s, p50 1255 ms
+#   2 workers: 3.0 req/s, p50 1384 ms
+# A worker whose cores are all busy gains nothing from a second one. One
+# worker per 4 cores, each with 4 TF threads, 8 request threads and 2
+# inter-op threads are starting points, not measured optima: rerun the
+# benchmark on the serving machine (e.g. --workers 1 2 4 --cores N) before
+# changing these defaults.
+cores = int(os.environ.get("SERVING_CORES", 0)) or available_cores
+workers = int(os.environ.get("WEB_CONCURRENCY", 0)) or max(1, cores // 4)
+threads = int(os.environ.get("WEB_THREADS", 8))
+intra_op_threads = int(os.environ.get("TF_INTRA_OP_THREADS", 0)) or max(
+    1, cores // workers
+)
+inter_op_threads = int(os.environ.get("TF_INTER_OP_THREADS", 2))
+
+# Request threads feed the worker's InferenceScheduler, which batches them.
+worker_class = "gthread"
+bind = f"0.0.0.0:{os.environ.get('PORT', 8501)}"
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+preload_app = False  # see above
+
+# Inherited by the workers and read by model.py before the first op runs.
+os.environ["TF_INTRA_OP_THREADS"] = str(intra_op_threads)
+os.environ["TF_INTER_OP_THREADS"] = str(inter_op_threads)
+os.environ.setdefault("OMP_NUM_THREADS", str(intra_op_threads))
+# Each worker writes its metrics here, so any worker can answer for all.
+metrics_dir = os.environ.setdefault(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), f"caption-metrics-{os.getpid()}")
+)
+
+
+def on_starting(server):
+    clear_metrics()  # counters of an earlier run
+    started = time.perf_counter()
+    size = 0
+    for path in model_files():
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                size += len(chunk)
+    server.log.info(
+        "Preloaded %.1f MiB of model files in %.2fs; %d workers x %d TF threads",
+        size / 2**20,
+        time.perf_counter() - started,
+        workers,
+        intra_op_threads,
+    )
+
+
+def model_files():
+    # The files serving_model.load_caption_model will open, found without
+    # TensorFlow by the same rules; feature shards, older checkpoints and
+    # other exports stay out of the page cache.
+    if os.environ.get("TFLITE_MODEL_DIR"):
+        return glob.glob(os.path.join(os.environ["TFLITE_MODEL_DIR"], "*"))
+
+    checkpoint = latest_checkpoint(os.path.join(SAVED_MODELS_DIR, "finetune"))
+    checkpoint_files = glob.glob(f"{checkpoint}.*") if checkpoint else []
+    serving_dir = os.path.join(SAVED_MODELS_DIR, "caption_serving")
+    exported = os.path.join(serving_dir, "saved_model.pb")
+    if os.path.exists(exported) and (
+        checkpoint is None
+        or not os.path.exists(f"{checkpoint}.index")
+        or os.path.getmtime(exported) >= os.path.getmtime(f"{checkpoint}.index")
+    ):
+        return [exported] + glob.glob(os.path.join(serving_dir, "variables", "*"))
+
+    for name in ("image_captioning_coco_weights.h5", "xception_model.h5"):
+        weights = os.path.join(SAVED_MODELS_DIR, name)
+        if os.path.exists(weights):
+            return [weights] + checkpoint_files
+    return checkpoint_files
+
+
+def latest_checkpoint(directory):
+    # tf.train.latest_checkpoint: the path in the "checkpoint" state file.
+    try:
+        with open(os.path.join(directory, "checkpoint")) as f:
+            for line in f:
+                if line.startswith("model_checkpoint_path:"):
+                    path = line.split(":", 1)[1].strip().strip('"')
+                    return os.path.join(directory, path)
+    except OSError:
+        pass
+    return None
+
+
+def on_exit(server):
+    clear_metrics()
+    try:
+        os.rmdir(metrics_dir)
+    except OSError:
+        pass  # not empty or already gone
+
+
+def clear_metrics():
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+
+
+def post_worker_init(worker):
+    # Hold the worker back until its model is ready, heartbeating meanwhile
+    # so the master does not time it out during a slow load.
+    from app import model_registry
+
+    while model_registry.status()["state"] == "loading":
+        worker.notify()
+        time.sleep(1)
+    worker.log.info("Caption model %s", model_registry.status()["state"])
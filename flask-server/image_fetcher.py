@@ -0,0 +1,227 @@
+import argparse
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class FetchError(RuntimeError):
+    pass
+
+
+class FetchTooLarge(FetchError):
+    pass
+
+
+class FetchTimeout(FetchError):
+    pass
+
+
+class ImageFetcher:
+    """Downloads remote images through a shared connection pool.
+
+    Every fetch is bounded: connect and read timeouts per socket operation, a
+    total deadline for the whole body and a byte limit enforced while
+    streaming, so a slow or huge remote file cannot hold a worker thread.
+    """
+
+    def __init__(
+        self,
+        max_bytes,
+        connect_timeout=3.05,
+        read_timeout=10,
+        total_timeout=30,
+        pool_size=16,
+        max_workers=8,
+        chunk_size=64 * 1024,
+    ):
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.chunk_size = chunk_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="image-fetcher"
+        )
+
+    def fetch(self, url):
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                if length and length.isdigit() and int(length) > self.max_bytes:
+                    raise FetchTooLarge(
+                        f"Remote file is larger than {self.max_bytes} bytes"
+                    )
+                return self._read_body(url, response)
+        except requests.Timeout as e:
+            raise FetchTimeout(f"Fetching {url} timed out") from e
+        except requests.RequestException as e:
+            raise FetchError(str(e)) from e
+
+    def _read_body(self, url, response):
+        # The read timeout only bounds each socket read, so a server that
+        # trickles bytes is cut off by shutting the socket at the deadline,
+        # which also wakes up the blocked read.
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            sock = getattr(response.raw.connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            response.close()
+
+        timer = threading.Timer(self.total_timeout, expire)
+        timer.start()
+        try:
+            chunks = []
+            received = 0
+            for chunk in response.iter_content(self.chunk_size):
+                received += len(chunk)
+                if received > self.max_bytes:
+                    raise FetchTooLarge(
+                        f"Remote file is larger than {self.max_bytes} bytes"
+                    )
+                chunks.append(chunk)
+        except FetchTooLarge:
+            raise
+        except Exception as e:
+            if expired.is_set():
+                raise FetchTimeout(f"Fetching {url} took too long") from e
+            raise
+        finally:
+            timer.cancel()
+
+        if expired.is_set():
+            raise FetchTimeout(f"Fetching {url} took too long")
+        return b"".join(chunks)
+
+    def fetch_many(self, urls):
+        # Returns one entry per URL, in order: the bytes or the FetchError.
+        def fetch_or_error(url):
+            try:
+                return self.fetch(url)
+            except FetchError as e:
+                return e
+
+        return list(self._executor.map(fetch_or_error, urls))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # /image?size=N serves N bytes, /slow?delay=S sleeps before answering and
+    # /drip?delay=S sends one byte per S seconds.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = dict(part.split("=", 1) for part in query.split("&") if "=" in part)
+        size = int(params.get("size", 1024))
+        delay = float(params.get("delay", 0))
+
+        if path == "/slow":
+            time.sleep(delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if path == "/drip":
+            for _ in range(size):
+                self.wfile.write(b"\0")
+                self.wfile.flush()
+                time.sleep(delay)
+        else:
+            self.wfile.write(b"\0" * size)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients hang up on purpose in the limit checks
+
+
+def start_stub_server():
+    server = _StubServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def benchmark(requests_count=200, size=256 * 1024, max_bytes=16 * 1024 * 1024):
+    # Offline check of throughput (pooled vs fresh connections) and of the
+    # timeout and size limits, against a local stub server.
+    server, base = start_stub_server()
+    url = f"{base}/image?size={size}"
+    results = {}
+    try:
+        started = time.perf_counter()
+        for _ in range(requests_count):
+            requests.get(url, timeout=10).content
+        results["unpooled_per_second"] = requests_count / (
+            time.perf_counter() - started
+        )
+
+        fetcher = ImageFetcher(max_bytes)
+        started = time.perf_counter()
+        for _ in range(requests_count):
+            fetcher.fetch(url)
+        results["pooled_per_second"] = requests_count / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        fetcher.fetch_many([url] * requests_count)
+        results["concurrent_per_second"] = requests_count / (
+            time.perf_counter() - started
+        )
+
+        checks = {
+            "too_large": (ImageFetcher(size // 2), f"{base}/image?size={size}"),
+            "read_timeout": (
+                ImageFetcher(max_bytes, read_timeout=0.2),
+                f"{base}/slow?delay=1",
+            ),
+            "total_timeout": (
+                ImageFetcher(max_bytes, read_timeout=1, total_timeout=0.5),
+                f"{base}/drip?size=20&delay=0.05",
+            ),
+        }
+        for name, (checker, check_url) in checks.items():
+            started = time.perf_counter()
+            try:
+                checker.fetch(check_url)
+                outcome = "no error"
+            except FetchError as e:
+                outcome = type(e).__name__
+            results[name] = {
+                "error": outcome,
+                "seconds": round(time.perf_counter() - started, 3),
+            }
+    finally:
+        server.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image fetcher")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.requests, args.size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
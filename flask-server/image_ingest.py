@@ -0,0 +1,87 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from embedding_cache import content_hash
+from metrics import STAGE_SECONDS
+
+IMAGE_SIZE = (299, 299)
+
+
+def decode_image_bytes(data, size=IMAGE_SIZE):
+    # Any format PIL can read. For JPEGs, draft() lets libjpeg decode at the
+    # smallest 1/2, 1/4 or 1/8 scale that is still at least `size`, so large
+    # photos are never decoded at full resolution.
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", size)
+        pixels = np.asarray(img.convert("RGB"))
+
+    img = tf.image.resize(pixels, size)
+    img = tf.keras.applications.inception_v3.preprocess_input(img)
+    return tf.cast(img, tf.float32)
+
+
+class ImageInput:
+    """An image received in a request, held in memory.
+
+    The content hash is the same one used for files on disk, so embeddings
+    cached for an upload are found again when the stored file is captioned.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.key = content_hash(data)
+        self._tensor = None
+
+    def tensor(self):
+        if self._tensor is None:
+            with STAGE_SECONDS.time(stage="image_decode"):
+                self._tensor = decode_image_bytes(self.data)
+        return self._tensor
+
+
+class AsyncImageWriter:
+    # Persists request images in the background, off the latency path.
+    # Readers of a file that may still be in flight call wait() first.
+
+    def __init__(self, directory, max_workers=2):
+        self.directory = directory
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="image-writer"
+        )
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def save(self, filename, data):
+        path = os.path.join(self.directory, filename)
+        future = self._executor.submit(self._write, path, data)
+        with self._lock:
+            self._pending[path] = future
+        future.add_done_callback(lambda done: self._finish(path, done))
+        return path
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with STAGE_SECONDS.time(stage="write"):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _finish(self, path, future):
+        with self._lock:
+            if self._pending.get(path) is future:
+                del self._pending[path]
+        if future.exception() is not None:
+            logging.error("Saving %s failed: %s", path, future.exception())
+
+    def wait(self, path, timeout=None):
+        with self._lock:
+            future = self._pending.get(path)
+        if future is not None:
+            future.result(timeout)
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from model import caption_images
+
+
+class InferenceScheduler:
+    """Collects captioning jobs from request threads and runs them in batches.
+
+    A batch is dispatched once it holds max_batch_size jobs or the oldest job
+    has waited max_wait_ms, whichever comes first. All jobs in a batch share
+    one cnn_model pass, one encoder pass and grouped decode passes.
+    """
+
+    def __init__(self, registry, max_batch_size=8, max_wait_ms=10, model_timeout=None):
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.model_timeout = model_timeout
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+
+        self._batches = 0
+        self._jobs = 0
+        self._failed_jobs = 0
+        self._max_queue_depth = 0
+        self._queue_seconds = 0.0
+        self._run_seconds = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="inference-scheduler", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, img, **options):
+        future = Future()
+        with self._condition:
+            self._queue.append((img, options, future, time.perf_counter()))
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            self._condition.notify()
+        self.start()
+        return future
+
+    def caption(self, img, timeout=None, **options):
+        return self.submit(img, **options).result(timeout)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+
+            deadline = self._queue[0][3] + self.max_wait
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            size = min(len(self._queue), self.max_batch_size)
+            return [self._queue.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            jobs = [job for job in batch if job[2].set_running_or_notify_cancel()]
+            if jobs:
+                self._run_batch(jobs)
+
+            with self._condition:
+                self._batches += 1
+                self._jobs += len(batch)
+                self._queue_seconds += sum(started - job[3] for job in batch)
+                self._run_seconds += time.perf_counter() - started
+
+    def _run_batch(self, jobs):
+        try:
+            model = self.registry.get(timeout=self.model_timeout)
+            results = caption_images(
+                [job[0] for job in jobs], model, [job[1] for job in jobs]
+            )
+        except Exception as e:
+            if len(jobs) == 1 or not self.registry.ready:
+                self._fail(jobs, e)
+                return
+            # One bad input (e.g. an undecodable image) must not fail the
+            # whole batch, so retry the jobs one by one.
+            logging.warning("Batched inference failed, retrying jobs singly: %s", e)
+            for job in jobs:
+                self._run_batch([job])
+            return
+
+        for job, captions in zip(jobs, results):
+            job[2].set_result(captions)
+
+    def _fail(self, jobs, error):
+        with self._condition:
+            self._failed_jobs += len(jobs)
+        for job in jobs:
+            job[2].set_exception(error)
+
+    def stats(self):
+        with self._condition:
+            batches = self._batches
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._max_queue_depth,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": batches,
+                "jobs": self._jobs,
+                "failed_jobs": self._failed_jobs,
+                "mean_batch_size": self._jobs / batches if batches else 0.0,
+                "mean_batch_fill": (
+                    self._jobs / (batches * self.max_batch_size) if batches else 0.0
+                ),
+                "mean_queue_ms": (
+                    self._queue_seconds / self._jobs * 1000 if self._jobs else 0.0
+                ),
+                "mean_batch_ms": (
+                    self._run_seconds / batches * 1000 if batches else 0.0
+                ),
+            }
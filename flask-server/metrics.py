@@ -0,0 +1,274 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cached embedding lookup to a cold model load
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+METRICS_DIR = os.environ.get("METRICS_DIR")  # shared by the server workers
+METRICS_FLUSH_SECONDS = 5
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [list(key), [list(counts), total]]
+                for key, (counts, total) in self._values.items()
+            ]
+
+
+class MetricsRegistry:
+    """Counters and histograms of one process, rendered for Prometheus.
+
+    Updates take one uncontended lock and a bisect, a few microseconds at
+    most, so instrumentation stays on in production. Values that other
+    objects already count (cache hits, queue depths) are read by collectors
+    at scrape time instead of being counted twice.
+
+    With a directory, each process writes its snapshot there every few
+    seconds and a scrape of any process reports the sum over all of them,
+    so gunicorn workers look like one server. Counters of exited workers
+    keep counting towards the totals; their gauges are dropped.
+    """
+
+    def __init__(self, directory=None, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collect, shared=False):
+        # collect() returns (name, "counter" or "gauge", labels, value)
+        # tuples, with labels a dict. Shared collectors report state that all
+        # processes see alike (e.g. a file they share); they run only in the
+        # scraped process, so their values are not summed over workers.
+        self._collectors.append((collect, shared))
+
+    def _collect(self, metrics, shared):
+        for collect, collector_shared in self._collectors:
+            if collector_shared != shared:
+                continue
+            for name, kind, labels, value in collect():
+                metric = metrics.setdefault(
+                    name,
+                    {
+                        "type": kind,
+                        "help": None,
+                        "labelnames": list(labels),
+                        "buckets": [],
+                        "samples": [],
+                    },
+                )
+                metric["samples"].append([[str(v) for v in labels.values()], value])
+
+    def snapshot(self):
+        metrics = {}
+        for metric in list(self._metrics.values()):
+            kind = "histogram" if isinstance(metric, Histogram) else "counter"
+            metrics[metric.name] = {
+                "type": kind,
+                "help": metric.help,
+                "labelnames": list(metric.labelnames),
+                "buckets": list(getattr(metric, "buckets", [])),
+                "samples": metric.snapshot(),
+            }
+        self._collect(metrics, shared=False)
+        return {"pid": os.getpid(), "metrics": metrics}
+
+    def start(self):
+        with self._lock:
+            if self.directory is None or self._flusher is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._flusher = threading.Thread(
+                target=self._flush_forever, name="metrics-flush", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            try:
+                self.flush()
+            except OSError:
+                pass  # the next flush tries again
+            time.sleep(self.flush_seconds)
+
+    def flush(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def _snapshots(self):
+        snapshots = [self.snapshot()]
+        if self.directory is None or not os.path.isdir(self.directory):
+            return snapshots
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _alive(snapshot["pid"]):
+                snapshot["metrics"] = {
+                    name: metric
+                    for name, metric in snapshot["metrics"].items()
+                    if metric["type"] != "gauge"
+                }
+            snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        merged = {}
+        shared = {}
+        self._collect(shared, shared=True)
+        for snapshot in self._snapshots() + [{"metrics": shared}]:
+            for name, metric in snapshot["metrics"].items():
+                target = merged.setdefault(name, dict(metric, samples={}))
+                for labels, value in metric["samples"]:
+                    key = tuple(labels)
+                    if metric["type"] == "histogram":
+                        counts, total = target["samples"].get(
+                            key, ([0] * len(value[0]), 0.0)
+                        )
+                        value = (
+                            [a + b for a, b in zip(counts, value[0])],
+                            total + value[1],
+                        )
+                    else:
+                        value += target["samples"].get(key, 0)
+                    target["samples"][key] = value
+
+        lines = []
+        for name, metric in sorted(merged.items()):
+            if metric["help"]:
+                lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in metric["samples"].items():
+                labels = list(zip(metric["labelnames"], key))
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                bounds = [_number(b) for b in metric["buckets"]] + ["+Inf"]
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    le = _labels(labels + [("le", bound)])
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Process-wide registry used by all modules
+metrics = MetricsRegistry(METRICS_DIR)
+
+STAGE_SECONDS = metrics.histogram(
+    "caption_stage_seconds",
+    "Time spent in each stage of captioning",
+    ["stage"],
+)
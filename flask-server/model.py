@@ -1,8 +1,14 @@
-import pickle
+import math
+import re
+import time
 import tensorflow as tf
 import pandas as pd
 import numpy as np
 import os
+from embedding_cache import EmbeddingCache, content_hash
+from vocabulary import load_vocabulary
+from image_ingest import ImageInput
+from metrics import STAGE_SECONDS, metrics
 
 
 # CONTANTS
@@ -11,20 +17,37 @@ BATCH_SIZE = 32
 BUFFER_SIZE = 1000
 EMBEDDING_DIM = 512
 UNITS = 512
+EMBEDDING_CACHE_BYTES = int(os.environ.get("EMBEDDING_CACHE_BYTES", 256 * 1024 * 1024))
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
+GRAPH_DECODING = os.environ.get("GRAPH_DECODING", "1") == "1"
+XLA_DECODING = os.environ.get("XLA_DECODING", "0") == "1"
+# Per-process TensorFlow thread pools; 0 keeps TensorFlow's default of one
+# thread per core, which oversubscribes the CPU once several workers run.
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", 0))
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", 0))
+
+# The pools are created by the first op, so this has to run before any.
+if TF_INTRA_OP_THREADS:
+    tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+if TF_INTER_OP_THREADS:
+    tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
 
 
 # LOADING DATA
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Construct the relative path to the vocabulary file
-vocab_path = os.path.join(ROOT_DIR, "saved_vocabulary", "vocab_coco.file")
+# (converted from the pickled vocab_coco.file with vocabulary.py)
+vocab_path = os.path.join(ROOT_DIR, "saved_vocabulary", "vocab_coco.vocab")
 weights_path1 = os.path.join(
     ROOT_DIR, "saved_models", "image_captioning_coco_weights.h5"
 )
 weights_path2 = os.path.join(ROOT_DIR, "saved_models", "xception_model.h5")
+serving_model_path = os.path.join(ROOT_DIR, "saved_models", "caption_serving")
+finetune_dir = os.path.join(ROOT_DIR, "saved_models", "finetune")
 
 # Load the vocabulary file
-vocab = pickle.load(open(vocab_path, "rb"))
+vocab = load_vocabulary(vocab_path)
 
 tokenizer = tf.keras.layers.TextVectorization(
     standardize=None,
@@ -32,15 +55,39 @@ tokenizer = tf.keras.layers.TextVectorization(
     vocabulary=vocab,
 )
 
-idx2word = tf.keras.layers.StringLookup(
-    mask_token="", vocabulary=tokenizer.get_vocabulary(), invert=True
+idx2word = tf.keras.layers.StringLookup(mask_token="", vocabulary=vocab, invert=True)
+
+# InceptionV3 embeddings of clean images, shared by all inference paths
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_BYTES, EMBEDDING_CACHE_DIR)
+
+# Vectorised detokenisation: vocab_array[token_ids] maps a whole batch of IDs
+# to words in one NumPy call.
+vocab_array = np.array(vocab, dtype=object)
+
+START_TOKEN_ID = vocab.index("[start]")
+END_TOKEN_ID = vocab.index("[end]")
+
+DECODE_STEPS = metrics.histogram(
+    "caption_decode_steps",
+    "Decoder steps until [end] per caption (per beam for beam search)",
+    ["strategy"],
+    buckets=(2, 4, 6, 8, 10, 12, 15, 20, 25, 30, MAX_LENGTH - 1),
+)
+DECODED_TOKENS = metrics.counter(
+    "caption_decoded_tokens_total", "Tokens produced by the decoder", ["strategy"]
+)
+DECODE_TOKENS_PER_SECOND = metrics.histogram(
+    "caption_decode_tokens_per_second",
+    "Decoder throughput of one batched decode pass",
+    ["strategy"],
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
 )
 
 
 # MODEL
-def CNN_Encoder():
+def CNN_Encoder(weights="imagenet"):
     inception_v3 = tf.keras.applications.InceptionV3(
-        include_top=False, weights="imagenet"
+        include_top=False, weights=weights
     )
 
     output = inception_v3.output
@@ -171,6 +218,70 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):
         )
         return tf.tile(mask, mult)
 
+    # Incremental decoding: the self-attention keys/values of already decoded
+    # positions are cached and the cross-attention projections of the encoder
+    # output are computed once, so each step only processes the newest token.
+    def init_cache(self, encoder_output, max_len=MAX_LENGTH - 1):
+        batch_size = tf.shape(encoder_output)[0]
+        num_heads = self.attention_1._num_heads
+        key_dim = self.attention_1._key_dim
+        empty = tf.zeros((batch_size, max_len, num_heads, key_dim))
+        return {
+            "key": empty,
+            "value": empty,
+            "cross_key": self.attention_2._key_dense(encoder_output),
+            "cross_value": self.attention_2._value_dense(encoder_output),
+        }
+
+    def decode_step(self, token_ids, position, cache):
+        max_len = cache["key"].shape[1]
+        position = tf.convert_to_tensor(position, dtype=tf.int32)
+
+        embeddings = self.embedding.token_embeddings(token_ids[:, tf.newaxis])
+        embeddings += self.embedding.position_embeddings(tf.reshape(position, (1, 1)))
+
+        slot = tf.range(max_len) == position
+        slot = slot[tf.newaxis, :, tf.newaxis, tf.newaxis]
+        key = tf.where(slot, self.attention_1._key_dense(embeddings), cache["key"])
+        value = tf.where(
+            slot, self.attention_1._value_dense(embeddings), cache["value"]
+        )
+        causal_mask = tf.range(max_len) <= position
+        causal_mask = causal_mask[tf.newaxis, tf.newaxis, tf.newaxis, :]
+
+        attn_output_1 = cached_attention(
+            self.attention_1, embeddings, key, value, causal_mask
+        )
+        out_1 = self.layernorm_1(embeddings + attn_output_1)
+
+        attn_output_2 = cached_attention(
+            self.attention_2, out_1, cache["cross_key"], cache["cross_value"]
+        )
+        out_2 = self.layernorm_2(out_1 + attn_output_2)
+
+        ffn_out = self.ffn_layer_1(out_2)
+        ffn_out = self.ffn_layer_2(ffn_out)
+        ffn_out = self.layernorm_3(ffn_out + out_2)
+
+        # Logits for the newest token only; softmax is monotonic so callers
+        # that only need the argmax can skip it.
+        logits = tf.matmul(ffn_out[:, 0, :], self.out.kernel) + self.out.bias
+        cache = dict(cache, key=key, value=value)
+        return logits, cache
+
+
+def cached_attention(attention, x, key, value, key_mask=None):
+    # Same computation as MultiHeadAttention.call, but on precomputed keys and
+    # values, so only the query of the current token has to be projected.
+    query = attention._query_dense(x)
+    query = tf.multiply(query, 1.0 / math.sqrt(float(attention._key_dim)))
+    scores = tf.einsum("aecd,abcd->acbe", key, query)
+    if key_mask is not None:
+        scores += (1.0 - tf.cast(key_mask, scores.dtype)) * -1e9
+    scores = tf.nn.softmax(scores, axis=-1)
+    output = tf.einsum("acbe,aecd->abcd", scores, value)
+    return attention._output_dense(output)
+
 
 class ImageCaptioningModel(tf.keras.Model):
     def __init__(self, cnn_model, encoder, decoder, image_aug=None):
@@ -205,13 +316,18 @@ class ImageCaptioningModel(tf.keras.Model):
         acc = self.calculate_accuracy(y_true, y_pred, mask)
         return loss, acc
 
-    def train_step(self, batch):
-        imgs, captions = batch
-
+    def embed(self, imgs):
+        # Batches of precomputed cnn_model embeddings (rank 3) are used as is.
+        if imgs.shape.rank == 3:
+            return imgs
         if self.image_aug:
             imgs = self.image_aug(imgs)
+        return self.cnn_model(imgs)
+
+    def train_step(self, batch):
+        imgs, captions = batch
 
-        img_embed = self.cnn_model(imgs)
+        img_embed = self.embed(imgs)
 
         with tf.GradientTape() as tape:
             loss, acc = self.compute_loss_and_acc(img_embed, captions)
@@ -227,7 +343,7 @@ class ImageCaptioningModel(tf.keras.Model):
     def test_step(self, batch):
         imgs, captions = batch
 
-        img_embed = self.cnn_model(imgs)
+        img_embed = imgs if imgs.shape.rank == 3 else self.cnn_model(imgs)
 
         loss, acc = self.compute_loss_and_acc(img_embed, captions, training=False)
 
@@ -242,26 +358,93 @@ class ImageCaptioningModel(tf.keras.Model):
 
 
 def load_image_from_path(img_path):
-    img = tf.io.read_file(img_path)
-    img = tf.io.decode_jpeg(img, channels=3)
+    with STAGE_SECONDS.time(stage="read"):
+        data = tf.io.read_file(img_path)
+    with STAGE_SECONDS.time(stage="image_decode"):
+        return decode_image(data)
+
+
+def decode_image(data):
+    # Encoded image bytes to a preprocessed InceptionV3 input; also usable
+    # inside tf.data pipelines.
+    img = tf.io.decode_image(data, channels=3, expand_animations=False)
     img = tf.image.resize(img, (299, 299))  # Use tf.image.resize for resizing
     img = tf.keras.applications.inception_v3.preprocess_input(img)
     img = tf.cast(img, tf.float32)  # Ensure the image is of type tf.float32
     return img
 
 
-def generate_caption(img, caption_model, add_noise=False):
+def preprocess_caption(caption):
+    # Same standardization as the COCO captions the vocabulary was built from.
+    caption = caption.lower()
+    caption = re.sub(r"[^\w\s]", "", caption)
+    caption = re.sub(r"\s+", " ", caption).strip()
+    return f"[start] {caption} [end]"
+
+
+def image_key(img):
+    # Paths and in-memory uploads are keyed by the encoded bytes, so a cached
+    # embedding is found without decoding the image again.
+    if isinstance(img, ImageInput):
+        return img.key
     if isinstance(img, str):
-        img = load_image_from_path(img)
+        with STAGE_SECONDS.time(stage="read"), open(img, "rb") as f:
+            return content_hash(f.read())
+    return content_hash(np.asarray(img, dtype=np.float32).tobytes())
+
 
+def image_tensor(img):
+    # Accepts a file path, an ImageInput or an already preprocessed tensor.
+    if isinstance(img, ImageInput):
+        return img.tensor()
+    if isinstance(img, str):
+        return load_image_from_path(img)
+    return img
+
+
+def embed_images(imgs, caption_model, num_noisy=None):
+    # Returns one array per image: the clean embedding first, followed by
+    # num_noisy[i] embeddings of noisy copies. Clean embeddings come from the
+    # cache when possible; everything else goes through cnn_model as one batch.
+    num_noisy = num_noisy or [0] * len(imgs)
+    keys = [image_key(img) for img in imgs]
+    cached = [embedding_cache.get(key) for key in keys]
+
+    batch = []
+    for i, img in enumerate(imgs):
+        if cached[i] is None or num_noisy[i]:
+            img = image_tensor(img)
+            if cached[i] is None:
+                batch.append(img)
+            batch.extend(add_image_noise(img) for _ in range(num_noisy[i]))
+    computed = iter([])
+    if batch:
+        with STAGE_SECONDS.time(stage="cnn"):
+            computed = iter(caption_model.cnn_model(tf.stack(batch)).numpy())
+
+    embeddings = []
+    for i, key in enumerate(keys):
+        clean = cached[i]
+        if clean is None:
+            clean = next(computed)
+            embedding_cache.put(key, clean)
+        noisy = [next(computed) for _ in range(num_noisy[i])]
+        embeddings.append(np.stack([clean] + noisy))
+    return embeddings
+
+
+def generate_caption(img, caption_model, add_noise=False, incremental=True):
     if add_noise == True:
-        noise = tf.random.normal(img.shape) * 0.1
-        img = img + noise
-        img = (img - tf.reduce_min(img)) / (tf.reduce_max(img) - tf.reduce_min(img))
+        img = add_image_noise(image_tensor(img))
+        img_embed = caption_model.cnn_model(tf.expand_dims(img, axis=0))
+    else:
+        img_embed = embed_images([img], caption_model)[0]
 
-    img = tf.expand_dims(img, axis=0)
-    img_embed = caption_model.cnn_model(img)
-    img_encoded = caption_model.encoder(img_embed, training=False)
+    with STAGE_SECONDS.time(stage="encoder"):
+        img_encoded = caption_model.encoder(img_embed, training=False)
+
+    if incremental:
+        return greedy_captions(caption_model, img_encoded)[0]
 
     y_inp = "[start]"
     for i in range(MAX_LENGTH - 1):
@@ -280,11 +463,403 @@ def generate_caption(img, caption_model, add_noise=False):
     return y_inp
 
 
-def get_caption_model():
+def add_image_noise(img):
+    noise = tf.random.normal(img.shape) * 0.1
+    img = img + noise
+    return (img - tf.reduce_min(img)) / (tf.reduce_max(img) - tf.reduce_min(img))
+
+
+def generate_caption_variants(img, caption_model, num_noisy=4):
+    # The clean image and its noisy variants go through the CNN, the encoder
+    # and the decoder as one batch instead of one generate_caption call each.
+    # Only the clean embedding is cached; the noisy ones differ every call.
+    img_embed = embed_images([img], caption_model, [num_noisy])[0]
+    img_encoded = caption_model.encoder(img_embed, training=False)
+    return greedy_captions(caption_model, img_encoded)
+
+
+DECODING_STRATEGIES = ("noise", "beam", "top_k", "top_p")
+DECODING_DEFAULTS = {
+    "strategy": "noise",
+    "num_captions": 5,
+    "beam_width": None,
+    "top_k": 40,
+    "top_p": 0.9,
+    "temperature": 1.0,
+    "seed": None,
+}
+
+
+def encode_image(img, caption_model):
+    img_embed = embed_images([img], caption_model)[0]
+    return caption_model.encoder(img_embed, training=False)
+
+
+def generate_diverse_captions(img, caption_model, **options):
+    return caption_images([img], caption_model, [options])[0]
+
+
+def caption_images(imgs, caption_model, options=None):
+    # Captions several images, each with its own decoding options, sharing
+    # one CNN pass, one encoder pass and as few decode passes as possible:
+    # "noise" reruns the CNN on noisy copies and decodes greedily, the other
+    # strategies encode the image once and diversify in the decoder.
+    options = [dict(DECODING_DEFAULTS, **opts) for opts in options or [{}] * len(imgs)]
+    for opts in options:
+        if opts["strategy"] not in DECODING_STRATEGIES:
+            raise ValueError(f"Unknown decoding strategy: {opts['strategy']}")
+
+    num_noisy = [
+        opts["num_captions"] - 1 if opts["strategy"] == "noise" else 0
+        for opts in options
+    ]
+    embeddings = embed_images(imgs, caption_model, num_noisy)
+    with STAGE_SECONDS.time(stage="encoder"):
+        img_encoded = caption_model.encoder(
+            tf.constant(np.concatenate(embeddings)), training=False
+        )
+    img_encoded = tf.split(img_encoded, [len(e) for e in embeddings])
+
+    # Jobs that can share a decode pass are grouped together.
+    groups = {}
+    for i, opts in enumerate(options):
+        if opts["strategy"] == "noise":
+            group = ("noise",)
+        elif opts["strategy"] == "beam":
+            beam_width = max(opts["beam_width"] or 1, opts["num_captions"])
+            group = ("beam", beam_width, opts["num_captions"])
+        else:
+            top_k = opts["top_k"] if opts["strategy"] == "top_k" else None
+            top_p = opts["top_p"] if opts["strategy"] == "top_p" else None
+            group = ("sample", top_k, top_p, opts["temperature"])
+        groups.setdefault(group, []).append(i)
+
+    results = [None] * len(imgs)
+    for group, members in groups.items():
+        if group[0] == "noise":
+            captions = greedy_captions(
+                caption_model, tf.concat([img_encoded[i] for i in members], 0)
+            )
+            offset = 0
+            for i in members:
+                size = len(embeddings[i])
+                results[i] = captions[offset : offset + size]
+                offset += size
+        elif group[0] == "beam":
+            _, beam_width, num_captions = group
+            captions = decode_beam_search(
+                caption_model.decoder,
+                tf.concat([img_encoded[i] for i in members], 0),
+                beam_width,
+                num_captions,
+            )
+            for i, image_captions in zip(members, captions):
+                results[i] = image_captions
+        else:
+            _, top_k, top_p, temperature = group
+            sizes = [options[i]["num_captions"] for i in members]
+            rows = [
+                tf.repeat(img_encoded[i], n, axis=0) for i, n in zip(members, sizes)
+            ]
+            captions = decode_sample(
+                caption_model.decoder,
+                tf.concat(rows, 0),
+                top_k,
+                top_p,
+                temperature,
+                rngs=[
+                    (np.random.default_rng(options[i]["seed"]), n)
+                    for i, n in zip(members, sizes)
+                ],
+            )
+            offset = 0
+            for i, size in zip(members, sizes):
+                results[i] = captions[offset : offset + size]
+                offset += size
+    return results
+
+
+def greedy_captions(caption_model, img_encoded):
+    if GRAPH_DECODING:
+        started = time.perf_counter()
+        token_ids = compiled_captioner(caption_model).decode_ids(img_encoded).numpy()
+        record_decode("greedy", caption_lengths(token_ids), started)
+        return detokenize(token_ids)
+    return decode_greedy(caption_model.decoder, img_encoded)
+
+
+def caption_lengths(token_ids):
+    # Decoder steps each row needed: up to and including its [end].
+    ended = token_ids == END_TOKEN_ID
+    return np.where(ended.any(axis=-1), ended.argmax(axis=-1) + 1, ended.shape[-1])
+
+
+def record_decode(strategy, steps, started):
+    seconds = time.perf_counter() - started
+    STAGE_SECONDS.observe(seconds, stage="caption_decode")
+    for count in steps:
+        DECODE_STEPS.observe(count, strategy=strategy)
+    tokens = int(np.sum(steps))
+    DECODED_TOKENS.inc(tokens, strategy=strategy)
+    if seconds > 0:
+        DECODE_TOKENS_PER_SECOND.observe(tokens / seconds, strategy=strategy)
+
+
+class CompiledCaptioner:
+    # Graph-compiled greedy captioning. The whole decode is one
+    # tf.while_loop over fixed MAX_LENGTH - 1 shaped buffers, so a caption is a
+    # single graph call; with jit_compile the graph is also compiled by XLA.
+    def __init__(self, caption_model, jit_compile=False):
+        self.caption_model = caption_model
+        self.caption_ids = tf.function(
+            self._caption_ids,
+            input_signature=[tf.TensorSpec((None, 299, 299, 3), tf.float32)],
+            jit_compile=jit_compile,
+        )
+        self.decode_ids = tf.function(
+            self._decode_ids,
+            input_signature=[tf.TensorSpec((None, None, EMBEDDING_DIM), tf.float32)],
+            jit_compile=jit_compile,
+        )
+
+    def _caption_ids(self, imgs):
+        img_embed = self.caption_model.cnn_model(imgs, training=False)
+        img_encoded = self.caption_model.encoder(img_embed, training=False)
+        return self._decode_ids(img_encoded)
+
+    def _decode_ids(self, img_encoded):
+        decoder = self.caption_model.decoder
+        max_len = MAX_LENGTH - 1
+        batch_size = tf.shape(img_encoded)[0]
+        cache = decoder.init_cache(img_encoded, max_len)
+        positions = tf.range(max_len)[tf.newaxis, :]
+
+        def cond(i, token_ids, finished, output, key, value):
+            return tf.logical_and(i < max_len, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(i, token_ids, finished, output, key, value):
+            logits, step_cache = decoder.decode_step(
+                token_ids, i, dict(cache, key=key, value=value)
+            )
+            key, value = step_cache["key"], step_cache["value"]
+            token_ids = tf.argmax(logits, axis=-1)
+            token_ids = tf.where(finished, tf.zeros_like(token_ids), token_ids)
+            output = tf.where(positions == i, token_ids[:, tf.newaxis], output)
+            finished = tf.logical_or(finished, token_ids == END_TOKEN_ID)
+            return i + 1, token_ids, finished, output, key, value
+
+        _, _, _, output, _, _ = tf.while_loop(
+            cond,
+            body,
+            (
+                tf.constant(0),
+                tf.fill([batch_size], tf.constant(START_TOKEN_ID, dtype=tf.int64)),
+                tf.zeros([batch_size], dtype=tf.bool),
+                tf.zeros([batch_size, max_len], dtype=tf.int64),
+                cache["key"],
+                cache["value"],
+            ),
+        )
+        return output
+
+
+def compiled_captioner(caption_model):
+    # Exported serving models (serving_model.py) bring their own graphs.
+    # Others keep theirs on the model, so that the graphs are freed with it
+    # when the registry swaps in a reloaded model.
+    captioner = getattr(caption_model, "captioner", None)
+    if captioner is None:
+        captioner = getattr(caption_model, "_compiled_captioner", None)
+    if captioner is None:
+        captioner = CompiledCaptioner(caption_model, jit_compile=XLA_DECODING)
+        caption_model._compiled_captioner = captioner
+    return captioner
+
+
+def decode_greedy(decoder, img_encoded):
+    return decode_tokens(
+        decoder, img_encoded, lambda logits: logits.argmax(axis=-1), "greedy"
+    )
+
+
+def decode_sample(
+    decoder,
+    img_encoded,
+    top_k=None,
+    top_p=None,
+    temperature=1.0,
+    seed=None,
+    rngs=None,
+):
+    # rngs is a list of (generator, row count) pairs, so rows of different
+    # requests can be decoded together and still follow their own seed.
+    if rngs is None:
+        rngs = [(np.random.default_rng(seed), img_encoded.shape[0])]
+
+    def sample(logits):
+        logits = logits / temperature
+        if top_k is not None and top_k < logits.shape[-1]:
+            kth = np.partition(logits, -top_k, axis=-1)[:, -top_k, np.newaxis]
+            logits = np.where(logits < kth, -np.inf, logits)
+        if top_p is not None:
+            order = np.argsort(-logits, axis=-1)
+            sorted_logits = np.take_along_axis(logits, order, axis=-1)
+            sorted_probs = np.exp(sorted_logits - sorted_logits[:, :1])
+            sorted_probs /= sorted_probs.sum(axis=-1, keepdims=True)
+            # Drop a token once the tokens ranked above it already cover top_p.
+            outside = np.cumsum(sorted_probs, axis=-1) - sorted_probs > top_p
+            np.put_along_axis(
+                logits, order, np.where(outside, -np.inf, sorted_logits), axis=-1
+            )
+        # Gumbel-max draws one token per row from softmax(logits).
+        gumbel = np.concatenate(
+            [rng.gumbel(size=(rows, logits.shape[-1])) for rng, rows in rngs]
+        )
+        return (logits + gumbel).argmax(axis=-1)
+
+    return decode_tokens(decoder, img_encoded, sample, "sample")
+
+
+def decode_tokens(decoder, img_encoded, choose_next, strategy):
+    started = time.perf_counter()
+    batch_size = img_encoded.shape[0]
+    cache = decoder.init_cache(img_encoded)
+    token_ids = np.full(batch_size, START_TOKEN_ID, dtype=np.int64)
+    output = np.zeros((batch_size, MAX_LENGTH - 1), dtype=np.int64)
+    finished = np.zeros(batch_size, dtype=bool)
+    for i in range(MAX_LENGTH - 1):
+        logits, cache = decoder.decode_step(tf.constant(token_ids), i, cache)
+        token_ids = choose_next(logits.numpy()).astype(np.int64)
+        output[:, i] = token_ids
+
+        # Finished rows keep running with the rest of the batch; detokenize
+        # drops everything after their [end].
+        finished |= token_ids == END_TOKEN_ID
+        if finished.all():
+            break
+
+    record_decode(strategy, caption_lengths(output), started)
+    return detokenize(output)
+
+
+def decode_beam_search(
+    decoder, img_encoded, beam_width=5, num_captions=None, length_penalty=0.7
+):
+    # All beams of all images are decoded as one batch of
+    # batch_size * beam_width rows; returns the best captions per image.
+    started = time.perf_counter()
+    num_captions = num_captions or beam_width
+    batch_size = img_encoded.shape[0]
+    cache = decoder.init_cache(tf.repeat(img_encoded, beam_width, axis=0))
+    token_ids = np.full(batch_size * beam_width, START_TOKEN_ID, dtype=np.int64)
+    sequences = np.zeros((batch_size, beam_width, MAX_LENGTH - 1), dtype=np.int64)
+    # Only the first beam is live at the start so the beams do not all
+    # expand the same [start] prefix.
+    scores = np.full((batch_size, beam_width), -np.inf)
+    scores[:, 0] = 0.0
+    hypotheses = [[] for _ in range(batch_size)]
+
+    def normalized(score, length):
+        return score / max(length, 1) ** length_penalty
+
+    for i in range(MAX_LENGTH - 1):
+        logits, cache = decoder.decode_step(tf.constant(token_ids), i, cache)
+        log_probs = tf.nn.log_softmax(logits).numpy()
+        candidates = scores[:, :, np.newaxis] + log_probs.reshape(
+            batch_size, beam_width, -1
+        )
+        candidates = candidates.reshape(batch_size, -1)
+
+        # Twice the beam width, so that enough candidates are left to refill
+        # the beams after the ones that produced [end] are set aside.
+        top = np.argpartition(-candidates, 2 * beam_width, axis=-1)
+        top = top[:, : 2 * beam_width]
+        top_scores = np.take_along_axis(candidates, top, axis=-1)
+        order = np.argsort(-top_scores, axis=-1)
+        top = np.take_along_axis(top, order, axis=-1)
+        top_scores = np.take_along_axis(top_scores, order, axis=-1)
+
+        vocab_size = log_probs.shape[-1]
+        origins = np.zeros((batch_size, beam_width), dtype=np.int64)
+        next_tokens = np.full((batch_size, beam_width), END_TOKEN_ID, dtype=np.int64)
+        next_scores = np.full((batch_size, beam_width), -np.inf)
+        for b in range(batch_size):
+            filled = 0
+            for flat_idx, score in zip(top[b], top_scores[b]):
+                if filled == beam_width or score == -np.inf:
+                    break
+                beam, token = divmod(int(flat_idx), vocab_size)
+                if token == END_TOKEN_ID:
+                    hypothesis = sequences[b, beam].copy()
+                    hypothesis[i] = END_TOKEN_ID
+                    hypotheses[b].append((normalized(score, i), hypothesis))
+                    continue
+                origins[b, filled] = beam
+                next_tokens[b, filled] = token
+                next_scores[b, filled] = score
+                filled += 1
+
+        sequences = np.take_along_axis(sequences, origins[:, :, np.newaxis], axis=1)
+        sequences[:, :, i] = next_tokens
+        scores = next_scores
+        token_ids = next_tokens.reshape(-1)
+        rows = (origins + np.arange(batch_size)[:, np.newaxis] * beam_width).reshape(-1)
+        cache = dict(
+            cache,
+            key=tf.gather(cache["key"], rows),
+            value=tf.gather(cache["value"], rows),
+        )
+
+        if all(len(found) >= num_captions for found in hypotheses):
+            break
+
+    record_decode("beam", [i + 1] * (batch_size * beam_width), started)
+    found = [
+        hypotheses[b]
+        + [
+            (normalized(scores[b, k], i + 1), sequences[b, k])
+            for k in range(beam_width)
+            if scores[b, k] > -np.inf
+        ]
+        for b in range(batch_size)
+    ]
+    all_captions = iter(detokenize([row for image in found for _, row in image]))
+
+    results = []
+    for image in found:
+        ranked = sorted(
+            zip((score for score, _ in image), all_captions),
+            key=lambda item: item[0],
+            reverse=True,
+        )
+        captions = []
+        for _, caption in ranked:
+            if caption not in captions:
+                captions.append(caption)
+        results.append(captions[:num_captions])
+    return results
+
+
+def detokenize(token_ids):
+    # Maps a (batch, length) array of IDs to captions with one vocabulary
+    # lookup. Everything from the first [end] on and padding IDs are dropped.
+    token_ids = np.asarray(token_ids)
+    if token_ids.size == 0:
+        return [""] * len(token_ids)
+    keep = np.cumsum(token_ids == END_TOKEN_ID, axis=-1) == 0
+    keep &= token_ids != 0
+    words = vocab_array[token_ids]
+    return [" ".join(row[mask]) for row, mask in zip(words, keep)]
+
+
+def build_caption_model():
+    # The architecture with every layer built but randomly initialized.
     encoder = TransformerEncoderLayer(EMBEDDING_DIM, 1)
     decoder = TransformerDecoderLayer(EMBEDDING_DIM, UNITS, 8)
 
-    cnn_model = CNN_Encoder()
+    # The caption weights file also holds the InceptionV3 weights, so there is
+    # no point downloading the ImageNet ones first.
+    cnn_model = CNN_Encoder(weights=None)
 
     caption_model = ImageCaptioningModel(
         cnn_model=cnn_model,
@@ -306,6 +881,13 @@ def get_caption_model():
     sample_img_embed = caption_model.cnn_model(sample_x)
     sample_enc_out = caption_model.encoder(sample_img_embed, training=False)
     caption_model.decoder(sample_y, sample_enc_out, training=False)
+    return caption_model
+
+
+def get_caption_model(finetuned=True):
+    # finetuned: True for the latest fine-tuning checkpoint, a checkpoint
+    # path for a specific one, or False for the released weights only.
+    caption_model = build_caption_model()
 
     try:
         caption_model.load_weights(weights_path1)
@@ -317,4 +899,17 @@ def get_caption_model():
                 "No weight files found. Please ensure that the weights files are available."
             )
 
+    # Encoder and decoder weights fine-tuned on user feedback, if any
+    if finetuned is True:
+        finetuned = tf.train.latest_checkpoint(finetune_dir)
+    if finetuned:
+        finetune_checkpoint(caption_model).restore(finetuned).expect_partial()
+
     return caption_model
+
+
+def finetune_checkpoint(caption_model, **extra):
+    # cnn_model is never fine-tuned, so only the encoder and decoder are saved.
+    return tf.train.Checkpoint(
+        encoder=caption_model.encoder, decoder=caption_model.decoder, **extra
+    )
@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+
+import tensorflow as tf
+
+from metrics import STAGE_SECONDS
+from model import get_caption_model, generate_caption
+
+
+class ModelNotReadyError(RuntimeError):
+    pass
+
+
+class ModelRegistry:
+    """Process-wide holder for the caption model.
+
+    The model is built, loaded and warmed up once per process; every request
+    thread then reuses the same instance. After the warm-up pass all layers are
+    built, so concurrent inference only reads the weights.
+    """
+
+    def __init__(self, loader=get_caption_model, version=None):
+        self._loader = loader
+        self._version_fn = version
+        self._version = None
+        self._load_lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._model = None
+        self._error = None
+        self._load_seconds = None
+        self._warmup_seconds = None
+        self._watcher = None
+
+    def start(self):
+        with self._load_lock:
+            if self._thread is not None or self._model is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._load_in_background,
+                name="caption-model-loader",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            logging.exception("Loading the caption model failed")
+        finally:
+            self._done.set()
+
+    def load(self):
+        with self._load_lock:
+            if self._model is not None:
+                return self._model
+
+            self._error = None
+            try:
+                version = self._current_version()
+                started = time.perf_counter()
+                model = self._loader()
+                loaded = time.perf_counter()
+                warm_up(model)
+                warmed = time.perf_counter()
+            except Exception as e:
+                self._error = e
+                raise
+
+            self._model = model
+            self._version = version
+            self._load_seconds = loaded - started
+            self._warmup_seconds = warmed - loaded
+            STAGE_SECONDS.observe(self._load_seconds, stage="model_load")
+            STAGE_SECONDS.observe(self._warmup_seconds, stage="warmup")
+            logging.info(
+                "Caption model ready (load %.2fs, warm-up %.2fs)",
+                self._load_seconds,
+                self._warmup_seconds,
+            )
+            return model
+
+    def reload(self):
+        # Builds and warms up a new model while the current one keeps serving,
+        # then swaps it in (e.g. after fine-tuning).
+        version = self._current_version()
+        started = time.perf_counter()
+        model = self._loader()
+        loaded = time.perf_counter()
+        warm_up(model)
+        warmed = time.perf_counter()
+
+        with self._load_lock:
+            self._model = model
+            self._version = version
+            self._error = None
+            self._load_seconds = loaded - started
+            self._warmup_seconds = warmed - loaded
+            self._done.set()
+        STAGE_SECONDS.observe(loaded - started, stage="model_load")
+        STAGE_SECONDS.observe(warmed - loaded, stage="warmup")
+        logging.info("Caption model reloaded")
+        return model
+
+    def _current_version(self):
+        return self._version_fn() if self._version_fn is not None else None
+
+    def watch(self, interval):
+        # Reloads the model whenever version() changes, so every server worker
+        # picks up a checkpoint that another process has saved.
+        if self._version_fn is None or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(
+            target=self._watch, args=(interval,), name="model-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self.ready and self._current_version() != self._version:
+                    self.reload()
+            except Exception:
+                logging.exception("Reloading the caption model failed")
+
+    def get(self, timeout=None):
+        if self._model is not None:
+            return self._model
+        if self._thread is None:
+            return self.load()
+        if not self._done.wait(timeout):
+            raise ModelNotReadyError("Caption model is still loading")
+        if self._model is None:
+            raise ModelNotReadyError(f"Caption model failed to load: {self._error}")
+        return self._model
+
+    @property
+    def ready(self):
+        return self._model is not None
+
+    @property
+    def version(self):
+        # version() as of when the current model was loaded
+        return self._version
+
+    def status(self):
+        if self._model is not None:
+            state = "ready"
+        elif self._error is not None:
+            state = "failed"
+        elif self._thread is not None:
+            state = "loading"
+        else:
+            state = "idle"
+
+        return {
+            "state": state,
+            "ready": state == "ready",
+            "load_seconds": self._load_seconds,
+            "warmup_seconds": self._warmup_seconds,
+            "version": self._version,
+            "error": str(self._error) if self._error is not None else None,
+        }
+
+
+def warm_up(caption_model):
+    # One full caption on a blank image traces every layer used at inference.
+    generate_caption(tf.zeros((299, 299, 3)), caption_model)
@@ -1,12 +1,22 @@
 import os
+import sys
 import logging
+from contextlib import contextmanager
 import pandas as pd
-import numpy as np
-from tensorflow.keras.models import load_model
+import tensorflow as tf
+from tensorflow.keras.callbacks import LambdaCallback
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.losses import SparseCategoricalCrossentropy
-from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+try:
+    import fcntl
+except ImportError:  # Windows; a single process serves there anyway
+    fcntl = None
+
+from feature_store import FeatureStore, extract_features
+from feedback_store import Feedback, FeedbackStore
+from model import finetune_checkpoint, finetune_dir, get_caption_model
+from upload_store import upload_path
 
 # Configure logging
 logging.basicConfig(
@@ -15,61 +25,159 @@ logging.basicConfig(
 
 # Constants
 ROOT_DIR = os.path.dirname(__file__)
-FEEDBACK_FILE = os.path.join(ROOT_DIR, "user_feedback.csv")
-MODEL_DIR = os.path.join(ROOT_DIR, "saved_models")
-MODEL_PATH = os.path.join(MODEL_DIR, "model_updated.h5")
-VOCAB_SIZE = 10000  # Adjust based on your vocabulary size
-MAX_SEQUENCE_LENGTH = 100  # Adjust based on your sequence length
-
-
-def preprocess_feedback(feedback_df):
-    tokenizer = Tokenizer(num_words=VOCAB_SIZE)
-
-    # Example: Tokenize captions
-    tokenizer.fit_on_texts(feedback_df["caption"])
-    sequences = tokenizer.texts_to_sequences(feedback_df["caption"])
-    data = pad_sequences(sequences, maxlen=MAX_SEQUENCE_LENGTH)
-
-    # Example: Convert labels to numpy array
-    labels = np.array(
-        feedback_df["label"]
-    )  # Adjust this line based on your labels format
-
-    return data, labels
-
-
-def retrain_model():
+DATA_DIR = os.environ.get("DATA_DIR", ROOT_DIR)  # shared with app.py
+FEEDBACK_DB = os.path.join(DATA_DIR, "user_feedback.db")
+FEATURES_DIR = os.path.join(ROOT_DIR, "saved_models", "features")
+RETRAIN_LOCK = os.path.join(finetune_dir, ".lock")
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+EPOCHS = 3
+LEARNING_RATE = 1e-5  # small, so a few confirmations nudge rather than overwrite
+CHECKPOINTS_TO_KEEP = 3
+
+# The model and checkpoint stay in memory between runs of a long-lived worker
+_training_state = None
+
+
+def resolve_image_path(image_path):
+    # /confirm stores upload file names, Streamlit absolute paths.
+    if os.path.isabs(image_path) or os.path.exists(image_path):
+        return image_path
+    return upload_path(UPLOAD_DIR, image_path) or os.path.join(UPLOAD_DIR, image_path)
+
+
+def load_feedback(since=0):
+    # Feedback records with an ID greater than since, streamed from the store.
+    store = FeedbackStore(FEEDBACK_DB)
+    return pd.DataFrame(store.iter_since(since), columns=Feedback._fields)
+
+
+def preprocess_feedback(feedback_df, caption_model):
+    # Returns a dataset of (embeddings, token IDs) batches streamed from the
+    # feature store, and its number of records, for the feedback whose image
+    # is still on disk. Only images not in the store yet go through
+    # cnn_model, once; training epochs never touch cnn_model at all.
+    paths = list(feedback_df["image_path"].map(resolve_image_path))
+    store = FeatureStore(FEATURES_DIR)
+    extract_features(store, paths, caption_model.cnn_model)
+    available = [path in store.paths for path in paths]
+    if not all(available):
+        logging.warning(
+            "Skipping %d feedback images not on disk or not decodable.",
+            available.count(False),
+        )
+    paths = [path for path, ok in zip(paths, available) if ok]
+    captions = [c for c, ok in zip(feedback_df["caption"], available) if ok]
+    if not paths:
+        return None, 0
+    return store.dataset(paths, captions), len(captions)
+
+
+@contextmanager
+def retrain_lock():
+    # Server workers each have a retrain queue; runs from different processes
+    # take turns, so each one trains on the checkpoint the previous one saved.
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(finetune_dir, exist_ok=True)
+    with open(RETRAIN_LOCK, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def training_state():
+    global _training_state
+    # Another process may have saved a checkpoint since this one was loaded.
+    if _training_state is not None:
+        manager = _training_state[2]
+        if manager.latest_checkpoint != tf.train.latest_checkpoint(finetune_dir):
+            _training_state = None
+    if _training_state is None:
+        caption_model = get_caption_model()  # restores the latest fine-tuning
+        caption_model.compile(
+            optimizer=Adam(LEARNING_RATE),
+            loss=SparseCategoricalCrossentropy(reduction="none"),
+        )
+        checkpoint = finetune_checkpoint(
+            caption_model,
+            optimizer=caption_model.optimizer,
+            last_feedback_id=tf.Variable(0, dtype=tf.int64),
+        )
+        manager = tf.train.CheckpointManager(
+            checkpoint, finetune_dir, max_to_keep=CHECKPOINTS_TO_KEEP
+        )
+        if manager.latest_checkpoint:
+            checkpoint.restore(manager.latest_checkpoint).expect_partial()
+        _training_state = caption_model, checkpoint, manager
+    return _training_state
+
+
+def retrain_model(progress=None, since=None):
+    # Fine-tunes the encoder and decoder on feedback received since the last
+    # checkpoint (or since the given feedback ID) and saves a new checkpoint.
+    # Returns False when there is nothing to train on. progress, if given, is
+    # called as progress(epoch, EPOCHS) after every epoch.
+    global _training_state
     try:
-        # Check if the feedback file exists
-        if not os.path.exists(FEEDBACK_FILE):
-            logging.error("Feedback file does not exist.")
-            return
-
-        # Load user feedback
-        feedback_df = pd.read_csv(FEEDBACK_FILE)
-        if feedback_df.empty:
-            logging.error("Feedback file is empty.")
-            return
-
-        # Preprocess feedback data
-        X_train, y_train = preprocess_feedback(feedback_df)
-
-        # Load the existing model
-        model = load_model(MODEL_PATH)
-        model.compile(optimizer=Adam(), loss=SparseCategoricalCrossentropy())
-
-        # Retrain the model
-        model.fit(X_train, y_train, epochs=3, batch_size=32, validation_split=0.2)
-
-        # Save updated weights
-        os.makedirs(MODEL_DIR, exist_ok=True)
-        model.save(MODEL_PATH)
-
-        logging.info("Model retrained and updated weights saved successfully.")
-
+        with retrain_lock():
+            return _retrain(progress, since)
     except Exception as e:
+        # The in-memory weights may be half-updated; reload them next time.
+        _training_state = None
         logging.error(f"An error occurred: {e}")
+        raise
+
+
+def _retrain(progress, since):
+    # Check if the feedback database exists
+    if not os.path.exists(FEEDBACK_DB):
+        logging.error("Feedback database does not exist.")
+        return False
+
+    caption_model, checkpoint, manager = training_state()
+    if since is None:
+        since = int(checkpoint.last_feedback_id.numpy())
+
+    # Load user feedback
+    feedback_df = load_feedback(since)
+    if feedback_df.empty:
+        logging.info("No new feedback since record %d.", since)
+        return False
+
+    # Preprocess feedback data
+    last_feedback_id = int(feedback_df["id"].max())
+    dataset, records = preprocess_feedback(feedback_df, caption_model)
+    if dataset is None:
+        logging.error("None of the feedback images are available.")
+        checkpoint.last_feedback_id.assign(last_feedback_id)
+        manager.save()
+        return False
+
+    # Fine-tune the model
+    callbacks = []
+    if progress is not None:
+        callbacks.append(
+            LambdaCallback(on_epoch_end=lambda epoch, logs: progress(epoch + 1, EPOCHS))
+        )
+    caption_model.fit(dataset, epochs=EPOCHS, callbacks=callbacks)
+
+    # Save the fine-tuned weights and how far the feedback was consumed
+    checkpoint.last_feedback_id.assign(last_feedback_id)
+    path = manager.save()
+
+    logging.info(
+        "Fine-tuned on %d feedback records, checkpoint saved to %s.",
+        records,
+        path,
+    )
+    return True
 
 
 if __name__ == "__main__":
-    retrain_model()
+    try:
+        retrain_model()
+    except Exception:
+        sys.exit(1)
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class RetrainQueue:
+    """Runs retraining in a long-lived background thread.
+
+    submit() returns a job ID at once. Jobs submitted while a run is waiting
+    to start join that run, and a run starts coalesce_seconds after its first
+    job, so a burst of confirmations trains the model once. Jobs submitted
+    during a run are queued for the next one. The thread lives in the serving
+    process, so TensorFlow is already imported when a run starts.
+    """
+
+    def __init__(self, train, coalesce_seconds=30, max_runs=100):
+        self.train = train
+        self.coalesce_seconds = coalesce_seconds
+        self.max_runs = max_runs
+        self._runs = OrderedDict()
+        self._jobs = {}
+        self._pending = None
+        self._running = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="retrain-queue", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self):
+        job_id = uuid.uuid4().hex
+        with self._condition:
+            if self._pending is None:
+                self._pending = {
+                    "run_id": uuid.uuid4().hex,
+                    "status": "queued",
+                    "jobs": [],
+                    "submitted_at": time.time(),
+                    "started_at": None,
+                    "finished_at": None,
+                    "epoch": 0,
+                    "epochs": None,
+                    "error": None,
+                }
+                self._add_run(self._pending)
+            self._pending["jobs"].append(job_id)
+            self._jobs[job_id] = self._pending["run_id"]
+            self._condition.notify()
+        self.start()
+        return job_id
+
+    def _add_run(self, run):
+        self._runs[run["run_id"]] = run
+        # Forget the oldest finished runs and the jobs that point to them.
+        while len(self._runs) > self.max_runs:
+            oldest = next(iter(self._runs.values()))
+            if oldest is self._pending or oldest is self._running:
+                break
+            del self._runs[oldest["run_id"]]
+            for job_id in oldest["jobs"]:
+                self._jobs.pop(job_id, None)
+
+    def status(self, job_id):
+        with self._condition:
+            run_id = self._jobs.get(job_id)
+            if run_id is None:
+                return None
+            run = self._runs[run_id]
+            status = {key: value for key, value in run.items() if key != "jobs"}
+            status["job_id"] = job_id
+            status["coalesced_jobs"] = len(run["jobs"])
+            if run is self._pending:
+                status["starts_in"] = max(
+                    0.0, run["submitted_at"] + self.coalesce_seconds - time.time()
+                )
+            return status
+
+    def _next_run(self):
+        with self._condition:
+            while self._pending is None:
+                self._condition.wait()
+            deadline = self._pending["submitted_at"] + self.coalesce_seconds
+            while time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+            run, self._pending = self._pending, None
+            run["status"] = "running"
+            run["started_at"] = time.time()
+            self._running = run
+            return run
+
+    def _progress(self, run, epoch, epochs):
+        with self._condition:
+            run["epoch"] = epoch
+            run["epochs"] = epochs
+
+    def _run(self):
+        while True:
+            run = self._next_run()
+            try:
+                trained = self.train(
+                    progress=lambda epoch, epochs: self._progress(run, epoch, epochs)
+                )
+                status, error = ("succeeded" if trained else "skipped"), None
+            except Exception as e:
+                logging.exception("Retraining run %s failed", run["run_id"])
+                status, error = "failed", str(e)
+
+            with self._condition:
+                run["status"] = status
+                run["error"] = error
+                run["finished_at"] = time.time()
+                self._running = None
+
+    def stats(self):
+        with self._condition:
+            finished = [
+                run for run in self._runs.values() if run["finished_at"] is not None
+            ]
+            return {
+                "pending_jobs": len(self._pending["jobs"]) if self._pending else 0,
+                "running": self._running is not None,
+                "runs": len(finished),
+                "failed_runs": sum(run["status"] == "failed" for run in finished),
+                "coalesce_seconds": self.coalesce_seconds,
+            }
@@ -0,0 +1,172 @@
+"""Throughput of the gunicorn server for different numbers of workers.
+
+For every worker count the server is started with gunicorn.conf.py, given
+the whole core budget (SERVING_CORES) split evenly into TensorFlow threads
+per worker, and loaded with concurrent /upload requests for a fixed time:
+
+    python serving_benchmark.py --workers 1 2 4 --cores 8 --concurrency 16
+
+Every request carries a distinct image, so neither the embedding cache
+nor the caption cache answers. The report lists requests per second and
+latency percentiles per worker count. More workers help while a single worker
+cannot keep its cores busy (the decode loop is mostly sequential); once
+workers x TF threads covers the cores, extra workers only add memory.
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+READY_PATTERN = re.compile(r"Caption model (\w+)")
+
+
+def sample_image(width=640, height=480, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize((width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def start_server(workers, cores, port, timeout):
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY=str(workers),
+        SERVING_CORES=str(cores),
+        PORT=str(port),
+    )
+    env.pop("TF_INTRA_OP_THREADS", None)  # derived from the core budget
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=ROOT_DIR,
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    # Wait until every worker has reported its model state.
+    ready = threading.Semaphore(0)
+
+    def watch_log():
+        for line in server.stderr:
+            match = READY_PATTERN.search(line)
+            if match:
+                if match.group(1) != "ready":
+                    print(line.rstrip(), file=sys.stderr)
+                ready.release()
+
+    threading.Thread(target=watch_log, daemon=True).start()
+    deadline = time.perf_counter() + timeout
+    for _ in range(workers):
+        if not ready.acquire(timeout=max(0, deadline - time.perf_counter())):
+            server.terminate()
+            raise RuntimeError(f"{workers} workers not ready after {timeout}s")
+    return server
+
+
+def run_load(url, concurrency, seconds, num_captions):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(index):
+        session = requests.Session()
+        count = 0
+        while time.perf_counter() < deadline:
+            # Different pixels every time: trailing bytes alone would make a
+            # near-duplicate, answered by the caption cache.
+            data = sample_image(seed=index * 10**6 + count)
+            count += 1
+            started = time.perf_counter()
+            try:
+                response = session.post(
+                    f"{url}/upload",
+                    files={"file": ("benchmark.jpg", data, "image/jpeg")},
+                    data={"num_captions": num_captions},
+                    timeout=300,
+                )
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": 1000 * float(np.percentile(latencies, 50)) if latencies else None,
+        "p90_ms": 1000 * float(np.percentile(latencies, 90)) if latencies else None,
+    }
+
+
+def benchmark(worker_counts, cores, concurrency, seconds, warmup, num_captions, port):
+    url = f"http://127.0.0.1:{port}"
+    results = []
+    for workers in worker_counts:
+        server = start_server(workers, cores, port, timeout=600)
+        try:
+            run_load(url, concurrency, warmup, num_captions)
+            result = run_load(url, concurrency, seconds, num_captions)
+        finally:
+            server.terminate()
+            server.wait()
+        result.update(workers=workers, tf_threads_per_worker=max(1, cores // workers))
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--cores", type=int, default=os.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=10)
+    parser.add_argument("--num-captions", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8601)
+    parser.add_argument("--report", help="also write the report here")
+    args = parser.parse_args()
+
+    results = benchmark(
+        args.workers,
+        args.cores,
+        args.concurrency,
+        args.seconds,
+        args.warmup,
+        args.num_captions,
+        args.port,
+    )
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import tensorflow as tf
+
+from model import (
+    CompiledCaptioner,
+    EMBEDDING_DIM,
+    MAX_LENGTH,
+    TF_INTRA_OP_THREADS,
+    finetune_dir,
+    get_caption_model,
+    serving_model_path,
+)
+
+IMAGE_SPEC = tf.TensorSpec((None, 299, 299, 3), tf.float32, name="images")
+
+
+def export_serving_model(caption_model, path=serving_model_path):
+    # Everything inference needs is traced into one SavedModel, so loading it
+    # neither downloads ImageNet weights nor rebuilds layers with dummy calls.
+    decoder = caption_model.decoder
+    captioner = CompiledCaptioner(caption_model)
+    num_heads = decoder.attention_1._num_heads
+    key_dim = decoder.attention_1._key_dim
+    embed_dim = caption_model.cnn_model.output_shape[-1]
+    embed_spec = tf.TensorSpec((None, None, embed_dim), tf.float32, name="img_embed")
+    encoded_spec = tf.TensorSpec((None, None, EMBEDDING_DIM), tf.float32)
+    cache_spec = tf.TensorSpec((None, MAX_LENGTH - 1, num_heads, key_dim), tf.float32)
+    cross_spec = tf.TensorSpec((None, None, num_heads, key_dim), tf.float32)
+
+    module = tf.Module()
+    module.model_variables = list(caption_model.variables)
+
+    @tf.function(input_signature=[IMAGE_SPEC])
+    def embed(images):
+        return caption_model.cnn_model(images, training=False)
+
+    @tf.function(input_signature=[embed_spec])
+    def encode_embeddings(img_embed):
+        return caption_model.encoder(img_embed, training=False)
+
+    @tf.function(input_signature=[IMAGE_SPEC])
+    def encode(images):
+        return {"encoder_output": encode_embeddings(embed(images))}
+
+    @tf.function(input_signature=[encoded_spec])
+    def init_cache(encoder_output):
+        return decoder.init_cache(encoder_output)
+
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec((None,), tf.int64, name="token_ids"),
+            tf.TensorSpec((), tf.int32, name="position"),
+            cache_spec,
+            cache_spec,
+            cross_spec,
+            cross_spec,
+        ]
+    )
+    def decode_step(token_ids, position, key, value, cross_key, cross_value):
+        cache = {
+            "key": key,
+            "value": value,
+            "cross_key": cross_key,
+            "cross_value": cross_value,
+        }
+        logits, cache = decoder.decode_step(token_ids, position, cache)
+        return {"logits": logits, "key": cache["key"], "value": cache["value"]}
+
+    @tf.function(input_signature=[IMAGE_SPEC])
+    def caption(images):
+        return {"token_ids": captioner.caption_ids(images)}
+
+    module.embed = embed
+    module.encode_embeddings = encode_embeddings
+    module.init_cache = init_cache
+    module.decode_step = decode_step
+    module.caption_ids = captioner.caption_ids
+    module.decode_ids = captioner.decode_ids
+
+    tf.saved_model.save(
+        module,
+        path,
+        signatures={
+            "serving_default": caption,
+            "encode": encode,
+            "decode_step": decode_step,
+        },
+    )
+
+
+class ServingDecoder:
+    def __init__(self, module):
+        self.module = module
+
+    def init_cache(self, encoder_output):
+        return self.module.init_cache(encoder_output)
+
+    def decode_step(self, token_ids, position, cache):
+        outputs = self.module.decode_step(
+            tf.cast(token_ids, tf.int64),
+            tf.constant(position, dtype=tf.int32),
+            cache["key"],
+            cache["value"],
+            cache["cross_key"],
+            cache["cross_value"],
+        )
+        cache = dict(cache, key=outputs["key"], value=outputs["value"])
+        return outputs["logits"], cache
+
+
+class ServingCaptionModel:
+    """Inference-only stand-in for ImageCaptioningModel backed by an export.
+
+    It offers what the inference functions in model.py use: cnn_model,
+    encoder, decoder.init_cache/decode_step and the compiled greedy graphs.
+    """
+
+    def __init__(self, path=serving_model_path):
+        self.module = tf.saved_model.load(path)
+        self.decoder = ServingDecoder(self.module)
+        self.captioner = self.module
+
+    def cnn_model(self, images, training=False):
+        return self.module.embed(tf.convert_to_tensor(images, dtype=tf.float32))
+
+    def encoder(self, img_embed, training=False):
+        return self.module.encode_embeddings(
+            tf.convert_to_tensor(img_embed, dtype=tf.float32)
+        )
+
+
+def load_serving_model(path=serving_model_path):
+    return ServingCaptionModel(path)
+
+
+def load_caption_model():
+    # TFLITE_MODEL_DIR selects a quantized TFLite export (tflite_model.py).
+    # Otherwise prefer the exported artifact unless it predates the latest
+    # fine-tuning; fall back to building the Keras model, which restores it.
+    if os.environ.get("TFLITE_MODEL_DIR"):
+        from tflite_model import load_tflite_model
+
+        directory = os.environ["TFLITE_MODEL_DIR"]
+        exported = os.path.getmtime(os.path.join(directory, "meta.json"))
+        finetuned = tf.train.latest_checkpoint(finetune_dir)
+        if finetuned is not None and os.path.getmtime(f"{finetuned}.index") > exported:
+            logging.warning(
+                "The TFLite model in %s predates the fine-tuning %s, which it "
+                "does not include; export it again with tflite_model.py.",
+                directory,
+                os.path.basename(finetuned),
+            )
+        return load_tflite_model(directory, num_threads=TF_INTRA_OP_THREADS or None)
+    exported = os.path.join(serving_model_path, "saved_model.pb")
+    finetuned = tf.train.latest_checkpoint(finetune_dir)
+    if os.path.exists(exported) and (
+        finetuned is None
+        or os.path.getmtime(exported) >= os.path.getmtime(f"{finetuned}.index")
+    ):
+        return load_serving_model(serving_model_path)
+    return get_caption_model()
+
+
+def model_version():
+    # Changes whenever a new fine-tuning checkpoint is saved, by any process.
+    # A TFLite export keeps its weights until it is exported again, so its
+    # version is that of the export instead.
+    if os.environ.get("TFLITE_MODEL_DIR"):
+        meta = os.path.join(os.environ["TFLITE_MODEL_DIR"], "meta.json")
+        return f"tflite-{os.stat(meta).st_mtime_ns}" if os.path.exists(meta) else None
+    finetuned = tf.train.latest_checkpoint(finetune_dir)
+    return os.path.basename(finetuned) if finetuned else None
+
+
+def time_loader(name):
+    started = time.perf_counter()
+    if name == "keras":
+        get_caption_model()
+    else:
+        load_serving_model()
+    return time.perf_counter() - started
+
+
+def benchmark_startup():
+    # Each loader runs in a fresh interpreter, so neither benefits from the
+    # other's warm caches; TensorFlow import time is excluded from both.
+    results = {}
+    for name in ("keras", "serving"):
+        output = subprocess.run(
+            [sys.executable, __file__, "time-load", name],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[f"{name}_seconds"] = float(output.strip().splitlines()[-1])
+    results["speedup"] = results["keras_seconds"] / results["serving_seconds"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caption model serving artifact")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="export the SavedModel")
+    export_parser.add_argument("--output", default=serving_model_path)
+    subparsers.add_parser("benchmark", help="compare startup times")
+    time_parser = subparsers.add_parser("time-load")
+    time_parser.add_argument("loader", choices=["keras", "serving"])
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_serving_model(get_caption_model(), args.output)
+        print(f"Exported serving model to {args.output}")
+    elif args.command == "benchmark":
+        print(json.dumps(benchmark_startup(), indent=2))
+    else:
+        print(time_loader(args.loader))
+
+
+if __name__ == "__main__":
+    main()
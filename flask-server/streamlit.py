@@ -1,18 +1,24 @@
 import io
 import os
-import sys
 import tempfile
 import streamlit as st
 import requests
-import subprocess
 from PIL import Image
-from model import get_caption_model, generate_caption
-from translate import Translator
+from embedding_cache import content_hash
+from feedback_store import FeedbackStore
+from model import generate_caption_variants
+from retrain_model import retrain_model
+from retrain_queue import RetrainQueue
+from serving_model import load_caption_model
+from translation_service import TranslationService
 
 # Constants
 MAX_LENGTH = 40
-RETRAIN_MODEL_SCRIPT = os.path.join(os.path.dirname(__file__), "retrain_model.py")
-USER_FEEDBACK_FILE = os.path.join(os.path.dirname(__file__), "user_feedback.csv")
+RETRAIN_COALESCE_SECONDS = 30
+# Shared with app.py and retrain_model.py
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+USER_FEEDBACK_DB = os.path.join(DATA_DIR, "user_feedback.db")
+TRANSLATION_CACHE_FILE = os.path.join(DATA_DIR, "translation_cache.jsonl")
 
 
 # Initialize session state
@@ -37,29 +43,57 @@ initialize_session_state()
 # Cache the model
 @st.cache_resource()
 def load_model():
-    return get_caption_model()
+    return load_caption_model()
 
 
 caption_model = load_model()
 
-# Initialize the translator
-translator = Translator(to_lang="pl")
 
+def retrain_and_reload(progress):
+    trained = retrain_model(progress=progress)
+    if trained:
+        # The next script run loads the fine-tuned weights.
+        load_model.clear()
+    return trained
 
-def translate_to_polish(text):
+
+# One retraining worker per process, shared by all sessions
+@st.cache_resource()
+def load_retrain_queue():
+    return RetrainQueue(retrain_and_reload, coalesce_seconds=RETRAIN_COALESCE_SECONDS)
+
+
+retrain_queue = load_retrain_queue()
+
+
+@st.cache_resource()
+def load_feedback_store():
+    return FeedbackStore(USER_FEEDBACK_DB)
+
+
+feedback_store = load_feedback_store()
+
+
+# Shared by all sessions, so a caption is translated once per process
+@st.cache_resource()
+def load_translation_service():
+    return TranslationService(path=TRANSLATION_CACHE_FILE)
+
+
+translation_service = load_translation_service()
+
+
+def translate_to_polish(texts):
     try:
-        return translator.translate(text)
+        return translation_service.translate_many(texts, "pl")
     except Exception as e:
         st.error(f"Translation error: {e}")
-        return text
+        return texts
 
 
 def generate_unique_captions(image_path, previous_captions):
     captions = set(previous_captions)
-    captions.add(generate_caption(image_path, caption_model))
-    captions.update(
-        generate_caption(image_path, caption_model, add_noise=True) for _ in range(4)
-    )
+    captions.update(generate_caption_variants(image_path, caption_model, num_noisy=4))
     return list(captions)
 
 
@@ -143,12 +177,16 @@ if st.button("Regenerate Captions"):
 if st.session_state.captions:
     st.markdown("#### Predicted subtitles:")
 
+    # Translate all captions in one batch instead of once per radio option
+    displayed_captions = (
+        translate_to_polish(st.session_state.captions)
+        if st.session_state.translate
+        else st.session_state.captions
+    )
     selected_caption_idx = st.radio(
         "Select the best description:",
         options=range(len(st.session_state.captions)),
-        format_func=lambda x: translate_to_polish(st.session_state.captions[x])
-        if st.session_state.translate
-        else st.session_state.captions[x],
+        format_func=lambda x: displayed_captions[x],
         index=st.session_state.selected_caption_index,
     )
 
@@ -163,30 +201,30 @@ if st.session_state.captions:
         ]
         st.write(
             "Selected description:",
-            translate_to_polish(st.session_state.selected_caption)
+            displayed_captions[st.session_state.selected_caption_index]
             if st.session_state.translate
             else st.session_state.selected_caption,
         )
 
-        # Save selected caption to CSV
-        with open(USER_FEEDBACK_FILE, "a") as f:
-            f.write(
-                f"{st.session_state.image_path},{st.session_state.selected_caption}\n"
-            )
-
-        # Retrain the model
+        # Save the selected caption
+        with open(st.session_state.image_path, "rb") as f:
+            image_hash = content_hash(f.read())
         try:
-            result = subprocess.run(
-                [sys.executable, RETRAIN_MODEL_SCRIPT],
-                check=True,
-                capture_output=True,
-                text=True,
+            feedback_store.add(
+                st.session_state.image_path,
+                st.session_state.selected_caption,
+                image_hash,
             )
-            st.success("The model has been updated based on your feedback!")
-            st.write(result.stdout)
-        except subprocess.CalledProcessError as e:
-            st.error(f"Error during model update: {e}")
-            st.write(e.stderr)
+        except Exception as e:
+            st.error(f"Could not save your feedback: {e}")
+            st.stop()
+
+        # Retrain the model in the background
+        job_id = retrain_queue.submit()
+        st.success(
+            "Thank you! The model will be updated based on your feedback "
+            f"in the background (job {job_id})."
+        )
 
         # Reset session state
         st.session_state.image_path = None
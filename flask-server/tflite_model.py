@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from feature_store import list_images
+from model import (
+    EMBEDDING_DIM,
+    END_TOKEN_ID,
+    MAX_LENGTH,
+    ROOT_DIR,
+    START_TOKEN_ID,
+    embedding_cache,
+    generate_caption,
+    get_caption_model,
+    load_image_from_path,
+)
+
+QUANTIZATIONS = ("float32", "float16", "dynamic", "int8")
+PARTS = ("cnn", "encoder", "cross", "decode_step")
+CALIBRATION_SIZE = 100
+CALIBRATION_STEPS = 8  # decode steps recorded per calibration image
+
+
+def tflite_model_path(quantization):
+    return os.path.join(ROOT_DIR, "saved_models", f"caption_tflite_{quantization}")
+
+
+def inference_modules(caption_model):
+    # One module per TFLite artifact. The decoder is split into the
+    # cross-attention projections of the encoder output, computed once per
+    # image, and a single incremental step on the key/value cache.
+    decoder = caption_model.decoder
+    num_heads = decoder.attention_1._num_heads
+    key_dim = decoder.attention_1._key_dim
+    num_patches, embed_dim = caption_model.cnn_model.output_shape[1:]
+    cache_shape = (None, MAX_LENGTH - 1, num_heads, key_dim)
+    cross_shape = (None, num_patches, num_heads, key_dim)
+
+    def cnn(images):
+        return {"img_embed": caption_model.cnn_model(images, training=False)}
+
+    def encoder(img_embed):
+        return {"encoder_output": caption_model.encoder(img_embed, training=False)}
+
+    def cross(encoder_output):
+        cache = decoder.init_cache(encoder_output)
+        return {"cross_key": cache["cross_key"], "cross_value": cache["cross_value"]}
+
+    def decode_step(token_ids, position, key, value, cross_key, cross_value):
+        cache = {
+            "key": key,
+            "value": value,
+            "cross_key": cross_key,
+            "cross_value": cross_value,
+        }
+        logits, cache = decoder.decode_step(token_ids, position, cache)
+        return {"logits": logits, "key": cache["key"], "value": cache["value"]}
+
+    signatures = {
+        "cnn": (cnn, [tf.TensorSpec((None, 299, 299, 3), tf.float32, "images")]),
+        "encoder": (
+            encoder,
+            [tf.TensorSpec((None, num_patches, embed_dim), tf.float32, "img_embed")],
+        ),
+        "cross": (
+            cross,
+            [
+                tf.TensorSpec(
+                    (None, num_patches, EMBEDDING_DIM), tf.float32, "encoder_output"
+                )
+            ],
+        ),
+        "decode_step": (
+            decode_step,
+            [
+                tf.TensorSpec((None,), tf.int64, "token_ids"),
+                tf.TensorSpec((), tf.int32, "position"),
+                tf.TensorSpec(cache_shape, tf.float32, "key"),
+                tf.TensorSpec(cache_shape, tf.float32, "value"),
+                tf.TensorSpec(cross_shape, tf.float32, "cross_key"),
+                tf.TensorSpec(cross_shape, tf.float32, "cross_value"),
+            ],
+        ),
+    }
+
+    modules = {}
+    for name, (fn, signature) in signatures.items():
+        module = tf.Module()
+        module.model_variables = list(caption_model.variables)
+        module.serve = tf.function(fn, input_signature=signature)
+        modules[name] = module
+    return modules
+
+
+def calibration_data(caption_model, paths):
+    # Inputs each part sees while the float32 model captions the calibration
+    # images, used as representative datasets for int8 quantization.
+    data = {part: [] for part in PARTS}
+    decoder = caption_model.decoder
+    for path in paths:
+        images = load_image_from_path(path)[tf.newaxis]
+        img_embed = caption_model.cnn_model(images, training=False)
+        encoder_output = caption_model.encoder(img_embed, training=False)
+        cache = decoder.init_cache(encoder_output)
+        data["cnn"].append({"images": images})
+        data["encoder"].append({"img_embed": img_embed})
+        data["cross"].append({"encoder_output": encoder_output})
+
+        token_ids = tf.constant([START_TOKEN_ID], dtype=tf.int64)
+        for position in range(CALIBRATION_STEPS):
+            data["decode_step"].append(
+                {
+                    "token_ids": token_ids,
+                    "position": tf.constant(position, dtype=tf.int32),
+                    **cache,
+                }
+            )
+            logits, cache = decoder.decode_step(token_ids, position, cache)
+            token_ids = tf.argmax(logits, axis=-1)
+            if token_ids[0] == END_TOKEN_ID:
+                break
+    return data
+
+
+def convert(module, quantization, representative=None):
+    with tempfile.TemporaryDirectory() as directory:
+        tf.saved_model.save(
+            module, directory, signatures={"serving_default": module.serve}
+        )
+        converter = tf.lite.TFLiteConverter.from_saved_model(directory)
+
+        if quantization != "float32":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "float16":
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == "int8":
+            # Calibrated int8 activations and weights, with float fallback for
+            # ops that have no integer kernel; inputs and outputs stay float.
+            converter.representative_dataset = lambda: (
+                {name: np.asarray(value) for name, value in sample.items()}
+                for sample in representative
+            )
+        return converter.convert()
+
+
+def export_tflite_model(
+    caption_model, directory, quantization="dynamic", calibration_paths=None
+):
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    if quantization == "int8" and not calibration_paths:
+        raise ValueError("int8 quantization needs calibration images")
+
+    data = {}
+    if quantization == "int8":
+        data = calibration_data(caption_model, calibration_paths)
+
+    decoder = caption_model.decoder
+    os.makedirs(directory, exist_ok=True)
+    for name, module in inference_modules(caption_model).items():
+        content = convert(module, quantization, data.get(name))
+        with open(os.path.join(directory, f"{name}.tflite"), "wb") as f:
+            f.write(content)
+
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "quantization": quantization,
+                "calibration_images": len(calibration_paths or []),
+                "num_heads": decoder.attention_1._num_heads,
+                "key_dim": decoder.attention_1._key_dim,
+            },
+            f,
+        )
+
+
+class TFLiteRunner:
+    # A TFLite interpreter is not thread-safe, so calls are serialized.
+
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self._lock = threading.Lock()
+
+    def __call__(self, **inputs):
+        inputs = {name: np.asarray(value) for name, value in inputs.items()}
+        with self._lock:
+            return self.runner(**inputs)
+
+
+class TFLiteDecoder:
+    def __init__(self, cross, step, num_heads, key_dim):
+        self.cross = cross
+        self.step = step
+        self.num_heads = num_heads
+        self.key_dim = key_dim
+
+    def init_cache(self, encoder_output, max_len=MAX_LENGTH - 1):
+        outputs = self.cross(encoder_output=encoder_output)
+        batch_size = outputs["cross_key"].shape[0]
+        empty = np.zeros(
+            (batch_size, max_len, self.num_heads, self.key_dim), dtype=np.float32
+        )
+        return {
+            "key": empty,
+            "value": empty,
+            "cross_key": outputs["cross_key"],
+            "cross_value": outputs["cross_value"],
+        }
+
+    def decode_step(self, token_ids, position, cache):
+        outputs = self.step(
+            token_ids=np.asarray(token_ids, dtype=np.int64),
+            position=np.int32(position),
+            key=cache["key"],
+            value=cache["value"],
+            cross_key=cache["cross_key"],
+            cross_value=cache["cross_value"],
+        )
+        cache = dict(cache, key=outputs["key"], value=outputs["value"])
+        return tf.convert_to_tensor(outputs["logits"]), cache
+
+
+class TFLiteCaptioner:
+    # Greedy decoding for greedy_captions, looping over the decode step.
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+
+    def decode_ids(self, img_encoded):
+        batch_size = img_encoded.shape[0]
+        cache = self.decoder.init_cache(img_encoded)
+        token_ids = np.full(batch_size, START_TOKEN_ID, dtype=np.int64)
+        output = np.zeros((batch_size, MAX_LENGTH - 1), dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        for i in range(MAX_LENGTH - 1):
+            logits, cache = self.decoder.decode_step(token_ids, i, cache)
+            token_ids = np.where(finished, 0, logits.numpy().argmax(axis=-1))
+            output[:, i] = token_ids
+            finished |= token_ids == END_TOKEN_ID
+            if finished.all():
+                break
+        return tf.constant(output)
+
+
+class TFLiteCaptionModel:
+    """Inference-only stand-in for ImageCaptioningModel backed by TFLite.
+
+    Offers the same surface as ServingCaptionModel, so generate_caption,
+    caption_images and the decoders in model.py run on it unchanged.
+    """
+
+    def __init__(self, directory, num_threads=None):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        runners = {
+            part: TFLiteRunner(os.path.join(directory, f"{part}.tflite"), num_threads)
+            for part in PARTS
+        }
+        self._cnn = runners["cnn"]
+        self._encoder = runners["encoder"]
+        self.decoder = TFLiteDecoder(
+            runners["cross"],
+            runners["decode_step"],
+            self.meta["num_heads"],
+            self.meta["key_dim"],
+        )
+        self.captioner = TFLiteCaptioner(self.decoder)
+
+    def cnn_model(self, images, training=False):
+        return tf.convert_to_tensor(self._cnn(images=images)["img_embed"])
+
+    def encoder(self, img_embed, training=False):
+        return tf.convert_to_tensor(
+            self._encoder(img_embed=img_embed)["encoder_output"]
+        )
+
+
+def load_tflite_model(directory, num_threads=None):
+    return TFLiteCaptionModel(directory, num_threads)
+
+
+def token_f1(caption, reference):
+    # Bag-of-words overlap between a caption and the float32 reference.
+    tokens, reference = caption.split(), reference.split()
+    common = sum(min(tokens.count(t), reference.count(t)) for t in set(tokens))
+    if not tokens or not reference or not common:
+        return float(tokens == reference)
+    precision, recall = common / len(tokens), common / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+
+def compare_models(models, paths, reference="float32"):
+    # Caption every image with every model; latency is end to end per image
+    # with the embedding cache cleared, so each model runs its own CNN.
+    captions = {}
+    results = {}
+    for name, (caption_model, size_bytes) in models.items():
+        generate_caption(load_image_from_path(paths[0]), caption_model)  # warm-up
+        latencies = []
+        captions[name] = []
+        for path in paths:
+            embedding_cache.clear()
+            started = time.perf_counter()
+            captions[name].append(generate_caption(path, caption_model))
+            latencies.append(time.perf_counter() - started)
+        results[name] = {
+            "size_mb": size_bytes / 2**20,
+            "mean_ms": 1000 * float(np.mean(latencies)),
+            "p90_ms": 1000 * float(np.percentile(latencies, 90)),
+        }
+
+    for name, result in results.items():
+        pairs = list(zip(captions[name], captions[reference]))
+        result["exact_match"] = float(np.mean([a == b for a, b in pairs]))
+        result["token_f1"] = float(np.mean([token_f1(a, b) for a, b in pairs]))
+        result["speedup"] = results[reference]["mean_ms"] / result["mean_ms"]
+    return results
+
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized TFLite caption model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="export TFLite artifacts")
+    export_parser.add_argument(
+        "--quantization", choices=QUANTIZATIONS, default="dynamic"
+    )
+    export_parser.add_argument("--output")
+    export_parser.add_argument("--calibration", help="directory or manifest of images")
+    export_parser.add_argument("--calibration-size", type=int, default=CALIBRATION_SIZE)
+    compare_parser = subparsers.add_parser(
+        "compare", help="accuracy and latency against the float32 Keras model"
+    )
+    compare_parser.add_argument("images", help="directory or manifest of images")
+    compare_parser.add_argument("--models", nargs="+", required=True)
+    compare_parser.add_argument("--limit", type=int, default=100)
+    compare_parser.add_argument("--threads", type=int)
+    compare_parser.add_argument("--report", help="also write the report here")
+    args = parser.parse_args()
+
+    caption_model = get_caption_model()
+    if args.command == "export":
+        calibration_paths = None
+        if args.calibration:
+            calibration_paths = list_images(args.calibration)[: args.calibration_size]
+        output = args.output or tflite_model_path(args.quantization)
+        export_tflite_model(caption_model, output, args.quantization, calibration_paths)
+        print(f"Exported {args.quantization} TFLite model to {output}")
+        return
+
+    weights = caption_model.trainable_weights + caption_model.non_trainable_weights
+    models = {
+        "float32": (caption_model, sum(w.numpy().nbytes for w in weights)),
+    }
+    for directory in args.models:
+        tflite_model = load_tflite_model(directory, args.threads)
+        name = f"tflite_{tflite_model.meta['quantization']}"
+        models[name] = (tflite_model, directory_size(directory))
+    paths = list_images(args.images)[: args.limit]
+    report = compare_models(models, paths)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from translate import Translator
+
+# The cache file is rewritten with the in-memory entries once it holds this
+# many times max_entries lines.
+COMPACT_RATIO = 2
+
+
+class RemoteTranslator:
+    # The default backend: one translate.Translator per target language,
+    # created on first use and reused afterwards.
+
+    def __init__(self, from_lang="en"):
+        self.from_lang = from_lang
+        self._translators = {}
+        self._lock = threading.Lock()
+
+    def translator(self, language):
+        with self._lock:
+            translator = self._translators.get(language)
+            if translator is None:
+                translator = Translator(to_lang=language, from_lang=self.from_lang)
+                self._translators[language] = translator
+            return translator
+
+    def translate(self, text, language):
+        translation = self.translator(language).translate(text)
+        # MyMemory reports quota problems in the translated text itself.
+        if translation.startswith("MYMEMORY WARNING"):
+            raise RuntimeError(translation)
+        return translation
+
+
+class TranslationService:
+    """Translates captions through a bounded LRU and a persistent cache.
+
+    Entries are keyed by (text, language). Misses in a batch are translated
+    concurrently, and a text already being translated for another request is
+    awaited rather than sent again, so each distinct caption reaches the
+    backend once. Any object with translate(text, language) can serve as the
+    backend. New translations are appended to the cache file, which is
+    compacted to the LRU contents when it grows past COMPACT_RATIO times
+    max_entries lines.
+    """
+
+    def __init__(self, backend=None, max_entries=4096, path=None, max_workers=8):
+        self.backend = backend or RemoteTranslator()
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._lines = 0  # in the cache file
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="translator"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.backend_calls = 0
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        # Later lines win, and only the newest max_entries are kept in memory.
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    text, language, translation = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                self._lines += 1
+                self._remember((text, language), translation)
+        if self._lines > COMPACT_RATIO * self.max_entries:
+            try:
+                with self._file_lock:
+                    self._compact()
+            except OSError as e:
+                logging.warning("Could not compact translations: %s", e)
+
+    def _remember(self, key, translation):
+        self._entries.pop(key, None)
+        self._entries[key] = translation
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _persist(self, key, translation):
+        if not self.path:
+            return
+        line = json.dumps([key[0], key[1], translation], ensure_ascii=False)
+        with self._file_lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._lines += 1
+            if self._lines > COMPACT_RATIO * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        # Called with self._file_lock held. The file is replaced atomically;
+        # lines another process appends meanwhile may be lost, which only
+        # costs a translation.
+        with self._lock:
+            entries = list(self._entries.items())
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for (text, language), translation in entries:
+                line = json.dumps([text, language, translation], ensure_ascii=False)
+                f.write(line + "\n")
+        os.replace(temp_path, self.path)
+        self._lines = len(entries)
+
+    def _translate(self, key, future):
+        try:
+            with self._lock:
+                self.backend_calls += 1
+            translation = self.backend.translate(*key)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._remember(key, translation)
+            del self._in_flight[key]
+        try:
+            self._persist(key, translation)
+        except OSError as e:
+            logging.warning("Could not persist translation: %s", e)
+        future.set_result(translation)
+
+    def submit(self, text, language):
+        key = (text, language)
+        with self._lock:
+            translation = self._entries.get(key)
+            if translation is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(translation)
+                return future
+
+            self.misses += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._in_flight[key] = future
+
+        self._executor.submit(self._translate, key, future)
+        return future
+
+    def translate(self, text, language):
+        return self.submit(text, language).result()
+
+    def translate_many(self, texts, language):
+        futures = [self.submit(text, language) for text in texts]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "backend_calls": self.backend_calls,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class _LocalTranslator:
+    # Offline stand-in for the remote backend with a fixed per-call latency.
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def translate(self, text, language):
+        time.sleep(self.latency)
+        return f"[{language}] {text}"
+
+
+def benchmark(latency=0.05, captions=10, rounds=5):
+    texts = [f"a man riding a surfboard {i}" for i in range(captions)]
+    backend = _LocalTranslator(latency)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            backend.translate(text, "pl")
+    sequential = time.perf_counter() - started
+
+    service = TranslationService(backend)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        service.translate_many(texts, "pl")
+    service_seconds = time.perf_counter() - started
+
+    return {
+        "sequential_seconds": sequential,
+        "service_seconds": service_seconds,
+        "speedup": sequential / service_seconds,
+        **service.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the translation cache against a local backend"
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--captions", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.latency, args.captions, args.rounds), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from embedding_cache import content_hash
+from image_ingest import AsyncImageWriter
+
+CONTENT_NAME = re.compile(r"^([0-9a-f]{64})\.(jpg|png)$")
+TOUCH_SECONDS = 60  # a file's mtime is refreshed at most this often
+EVICT_TO = 0.9  # eviction frees space down to this share of max_bytes
+
+
+def image_extension(data):
+    return "png" if data.startswith(b"\x89PNG\r\n\x1a\n") else "jpg"
+
+
+def content_digest(name):
+    # The SHA-256 in a content-addressed file name, or None.
+    match = CONTENT_NAME.match(name)
+    return match.group(1) if match else None
+
+
+def upload_path(directory, name):
+    # Content-addressed files live in two levels of shard directories; other
+    # names are files saved before uploads were content-addressed. Returns
+    # None for names that could point outside the directory.
+    digest = content_digest(name)
+    if digest is not None:
+        return os.path.join(directory, digest[:2], digest[2:4], name)
+    if not name or name != secure_filename(name):
+        return None
+    return os.path.join(directory, name)
+
+
+class UploadStore:
+    """Uploaded images, named by the SHA-256 of their bytes.
+
+    An image uploaded again, by anyone, gets the same name and is written
+    only once. Files are written in the background by an AsyncImageWriter;
+    readers call wait() first. The mtime of a file is its last use, and
+    once the files exceed max_bytes the least recently used ones are
+    deleted, by a scan of the directory, so that several processes can
+    share it. A file never changes under its name, so it can be served as
+    immutable.
+    """
+
+    def __init__(self, directory, max_bytes=10 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._writer = AsyncImageWriter(directory)
+        self._lock = threading.Lock()
+        self._bytes = None  # unknown until the first scan
+        self._evicting = False
+        self.saved = 0
+        self.deduplicated = 0
+        self.evicted = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return upload_path(self.directory, name)
+
+    def wait(self, path, timeout=None):
+        self._writer.wait(path, timeout)
+
+    def save(self, data):
+        name = f"{content_hash(data)}.{image_extension(data)}"
+        path = self.path(name)
+        if os.path.exists(path):
+            self.touch(path, force=True)
+            with self._lock:
+                self.deduplicated += 1
+            return name
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._writer.save(os.path.relpath(path, self.directory), data)
+        with self._lock:
+            self.saved += 1
+            if self._bytes is not None:
+                self._bytes += len(data)
+            evict = not self._evicting and (
+                self._bytes is None or self._bytes > self.max_bytes
+            )
+            self._evicting = self._evicting or evict
+        if evict:
+            threading.Thread(
+                target=self._evict_in_background, name="upload-eviction", daemon=True
+            ).start()
+        return name
+
+    def touch(self, path, force=False):
+        # Marks a file as used; eviction removes the least recently used.
+        try:
+            if force or time.time() - os.path.getmtime(path) > TOUCH_SECONDS:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def _files(self):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, "??", "??", "*")):
+            if content_digest(os.path.basename(path)) is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # evicted by another process
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _evict_in_background(self):
+        try:
+            self.evict()
+        except Exception:
+            logging.exception("Evicting uploads failed")
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def evict(self):
+        # Deletes the least recently used files until they fit into
+        # EVICT_TO * max_bytes, so that not every upload triggers a scan.
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        if total > self.max_bytes:
+            for _, size, path in files:
+                if total <= EVICT_TO * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._bytes = total
+            self.evicted += evicted
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "saved": self.saved,
+                "deduplicated": self.deduplicated,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,71 @@
+import argparse
+import os
+import pickle
+import struct
+
+import numpy as np
+
+# Layout: 8-byte magic, uint32 word count N, N + 1 uint32 byte offsets and the
+# UTF-8 encoded words concatenated into one blob (all little-endian). The
+# whole file is read in one call and sliced, with no per-word object
+# reconstruction as with the pickled numpy scalars.
+MAGIC = b"VOCAB\x00\x01\x00"
+HEADER = struct.Struct("<8sI")
+
+
+def write_vocabulary(path, words):
+    encoded = [str(word).encode("utf-8") for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(encoded)))
+        f.write(offsets.tobytes())
+        f.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+
+
+def load_vocabulary(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"Not a vocabulary file: {path}")
+
+    offsets = np.frombuffer(data, dtype="<u4", count=count + 1, offset=HEADER.size)
+    blob = data[HEADER.size + offsets.nbytes :]
+    if len(blob) != offsets[-1]:
+        raise ValueError(f"Truncated vocabulary file: {path}")
+
+    offsets = offsets.tolist()
+    return [
+        blob[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])
+    ]
+
+
+def convert_pickled_vocabulary(src, dst):
+    # The legacy files are pickled lists of numpy str_ scalars; only load
+    # trusted files here.
+    with open(src, "rb") as f:
+        words = pickle.load(f)
+    write_vocabulary(dst, words)
+    return len(words)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert pickled vocabulary files to the compact format."
+    )
+    parser.add_argument("src", nargs="+", help="pickled vocabulary files")
+    args = parser.parse_args()
+
+    for src in args.src:
+        dst = os.path.splitext(src)[0] + ".vocab"
+        count = convert_pickled_vocabulary(src, dst)
+        print(f"{src} -> {dst} ({count} words)")
+
+
+if __name__ == "__main__":
+    main()